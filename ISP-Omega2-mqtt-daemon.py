@@ -14,14 +14,24 @@ import re
 import json
 import os.path
 import argparse
+import select
+import errno
+import struct
+import ctypes
+import ctypes.util
+import concurrent.futures
+import zlib
+from http.server import HTTPServer, BaseHTTPRequestHandler
 from time import time, sleep, localtime, strftime
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from colorama import init as colorama_init
 from colorama import Fore, Back, Style
-from configparser import ConfigParser
+from configparser import ConfigParser, Error as ConfigParserError
 from unidecode import unidecode
 import paho.mqtt.client as mqtt
-from signal import signal, SIGPIPE, SIG_DFL
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
+from signal import signal, SIGPIPE, SIG_DFL, SIGKILL, SIGHUP
 signal(SIGPIPE,SIG_DFL)
 
 script_version = "1.1.0"
@@ -104,40 +114,119 @@ mqtt_client_connected = False
 print_line('* init mqtt_client_connected=[{}]'.format(mqtt_client_connected), debug=True)
 mqtt_client_should_attempt_reconnect = True
 
-def on_connect(client, userdata, flags, rc):
+mqtt_fallback_to_v311_requested = False
+# MQTT v5: topic aliases the broker allows us and those already sent on this connection
+mqtt_topic_alias_max = 0
+mqtt_topic_aliases_sent = set()
+mqtt_topic_aliases_lock = threading.Lock()
+
+def on_connect(client, userdata, flags, rc, properties=None):
     global mqtt_client_connected
+    global mqtt_fallback_to_v311_requested
+    global mqtt_topic_alias_max
     if rc == 0:
         print_line('* MQTT connection established', console=True, sd_notify=True)
         print_line('')  # blank line?!
         #_thread.start_new_thread(afterMQTTConnect, ())
+        # topic aliases are per-connection, start fresh
+        with mqtt_topic_aliases_lock:
+            mqtt_topic_aliases_sent.clear()
+        mqtt_topic_alias_max = 0
+        if properties is not None and hasattr(properties, 'TopicAliasMaximum'):
+            mqtt_topic_alias_max = properties.TopicAliasMaximum
+            print_line('on_connect() broker TopicAliasMaximum=[{}]'.format(mqtt_topic_alias_max), debug=True)
         mqtt_client_connected = True
         print_line('on_connect() mqtt_client_connected=[{}]'.format(mqtt_client_connected), debug=True)
+        saveTlsSession(client)
+        subscribeCommandTopics(client)
+        # retained, so it stands until our (retained) LWT replaces it
+        publishAliveStatus()
+    elif mqtt_protocol == mqtt.MQTTv5 and rc in (1, 132):
+        # 1 = (v3.1.1) unacceptable protocol version, 132 = (v5) unsupported protocol version
+        print_line('! Broker does not support MQTT v5 ({}), falling back to v3.1.1'.format(rc), warning=True)
+        mqtt_fallback_to_v311_requested = True
     else:
-        print_line('! Connection error with result code {} - {}'.format(str(rc), mqtt.connack_string(rc)), error=True)
-        print_line('MQTT Connection error with result code {} - {}'.format(str(rc), mqtt.connack_string(rc)), error=True, sd_notify=True)
+        print_line('! Connection error with result code {} - {}'.format(str(rc), connackText(rc)), error=True)
+        print_line('MQTT Connection error with result code {} - {}'.format(str(rc), connackText(rc)), error=True, sd_notify=True)
         mqtt_client_connected = False   # technically NOT useful but readying possible new shape...
         print_line('on_connect() mqtt_client_connected=[{}]'.format(mqtt_client_connected), debug=True, error=True)
         #kill main thread
         os._exit(1)
 
+def on_disconnect(client, userdata, rc, properties=None):
+    global mqtt_client_connected
+    mqtt_client_connected = False
+    # broker forgets our topic aliases when the connection drops
+    with mqtt_topic_aliases_lock:
+        mqtt_topic_aliases_sent.clear()
+    print_line('on_disconnect() rc=[{}]'.format(rc), debug=True)
+
+def connackText(rc):
+    if mqtt_protocol == mqtt.MQTTv5:
+        return str(rc)  # v5 ReasonCodes know their own name
+    return mqtt.connack_string(rc)
+
 def on_publish(client, userdata, mid):
     #print_line('* Data successfully published.')
     pass
 
+# command topic (relative to our base topic) -> handler(payload text)
+mqtt_command_handlers = OrderedDict()
+
+def on_message(client, userdata, message):
+    commandPrefix = '{}/'.format(base_topic)
+    if not message.topic.startswith(commandPrefix):
+        return
+    handler = mqtt_command_handlers.get(message.topic[len(commandPrefix):], None)
+    if handler is not None:
+        print_line('* command on [{}]'.format(message.topic), debug=True)
+        handler(message.payload.decode('utf-8', 'replace'))
+
+def subscribeCommandTopics(client):
+    for command in mqtt_command_handlers:
+        topic = '{}/{}'.format(base_topic, command)
+        client.subscribe(topic, qos=1)
+        print_line('- subscribed to [{}]'.format(topic), debug=True)
+
+def addCommandHandler(command, handler):
+    mqtt_command_handlers[command] = handler
+    if mqtt_client_connected:
+        topic = '{}/{}'.format(base_topic, command)
+        mqtt_client.subscribe(topic, qos=1)
+        print_line('- subscribed to [{}]'.format(topic), debug=True)
+
 def on_log(client, userdata, level, buf):
     #print_line('* Data successfully published.')
     print_line("log: {}".format(buf), debug=True, log=True)
 
 # Load configuration file
-config = ConfigParser(delimiters=('=', ), inline_comment_prefixes=('#'))
-config.optionxform = str
-try:
-    with open(os.path.join(config_dir, 'config.ini')) as config_file:
-        config.read_file(config_file)
-except IOError:
-    print_line('No configuration file "config.ini"', error=True, sd_notify=True)
+def loadConfigFile():
+    # returns (our parsed config.ini, error text) - config is None if we can't read or parse it
+    newConfig = ConfigParser(delimiters=('=', ), inline_comment_prefixes=('#'))
+    newConfig.optionxform = str
+    try:
+        with open(os.path.join(config_dir, 'config.ini')) as config_file:
+            newConfig.read_file(config_file)
+    except IOError:
+        return None, 'No configuration file "config.ini"!'
+    except ConfigParserError as parseErr:
+        return None, 'Configuration file "config.ini" is not valid! ({})'.format(str(parseErr).replace('\n', ' '))
+    return newConfig, ''
+
+config, config_error = loadConfigFile()
+if config is None:
+    print_line('ERROR: {} Fix and try again... Aborting'.format(config_error), error=True, sd_notify=True)
     sys.exit(1)
 
+# until we can reload (see startReloadHandling()) a SIGHUP must not kill us, just remember it
+reload_requested_during_startup = False
+
+def startupSighupHandler(signum, frame):
+    global reload_requested_during_startup
+    reload_requested_during_startup = True
+
+signal(SIGHUP, startupSighupHandler)
+
 daemon_enabled = config['Daemon'].getboolean('enabled', True)
 
 # default domain when hostname -f doesn't return it
@@ -152,20 +241,236 @@ update_flag_filespec = config['Daemon'].get('update_flag_filespec', default_upda
 default_base_topic = 'home/nodes'
 default_sensor_name = 'dvc-reporter'
 
-base_topic = config['MQTT'].get('base_topic', default_base_topic).lower()
-sensor_name = config['MQTT'].get('sensor_name', default_sensor_name).lower()
-
 # report our IoT values every 5min
 min_interval_in_minutes = 2
 max_interval_in_minutes = 30
 default_interval_in_minutes = 5
-interval_in_minutes = config['Daemon'].getint('interval_in_minutes', default_interval_in_minutes)
+
+# 'interval' reports every interval counted from our start, 'aligned' reports on wall-clock
+#  interval boundaries plus a per-device offset so a fleet started together doesn't report together
+REPORT_SCHEDULES = ['interval', 'aligned']
+default_report_schedule = REPORT_SCHEDULES[0]
+
+# when aligned, also spread our startup discovery over this many seconds (by the same per-device offset)
+default_startup_spread_in_seconds = 60
+startup_spread_in_seconds = config['Daemon'].getint('startup_spread_in_seconds', default_startup_spread_in_seconds)
+if startup_spread_in_seconds < 0:
+    print_line('ERROR: Invalid "startup_spread_in_seconds" found in configuration file: "config.ini"! Must be 0 (none) or more. Fix and try again... Aborting', error=True, sd_notify=True)
+    sys.exit(1)
+
+# republish right away when update-dates or network interfaces change (inotify/rtnetlink)
+event_triggers_enabled = config['Daemon'].getboolean('event_triggers', True)
+default_event_debounce_in_seconds = 5
+
+# each collector command must finish within this many seconds, else its last value is reported as stale
+default_collector_timeout_in_seconds = 10
+
+# number of collectors run at the same time during a report cycle (1 = one after another)
+default_collector_workers = 3
+collector_workers = config['Daemon'].getint('collector_workers', default_collector_workers)
+if collector_workers < 1:
+    print_line('ERROR: Invalid "collector_workers" found in configuration file: "config.ini"! Must be 1 or more. Fix and try again... Aborting', error=True, sd_notify=True)
+    sys.exit(1)
+
+# a report cycle running longer than this is reported as stuck
+default_watchdog_timeout_in_seconds = 60
+
+# low impact: run at low CPU/IO priority and back off (longer interval, fewer collectors) while the host is busy
+low_impact_enabled = config['Daemon'].getboolean('low_impact', False)
+default_throttle_load = 1.0             # 1-min load average per core
+default_throttle_cpu_in_seconds = 0.5   # our own CPU time per report cycle
+default_max_interval_stretch = 4        # interval may grow up to this many times
+
+# edge-triggered threshold alerts, each metric configured as: {set}, {clear}
+ALERT_FS_USED = 'fs_used_prcnt'     # per mount (fs_used_prcnt@{mount}) or all mounts, high alert
+ALERT_MEM_AVAIL = 'mem_avail_mb'    # low alert
+ALERT_LOAD = 'load_1min'            # high alert
+ALERT_LOW_METRICS = [ALERT_MEM_AVAIL]
+default_alert_sample_interval_in_seconds = 15
+
+# local time-series history (memory-mapped ring file), disabled when no file is given
+history_filespec = config['Daemon'].get('history_filespec', '')
+default_history_days = 3
+history_days = config['Daemon'].getint('history_days', default_history_days)
+default_history_chunk_records = 50
+if history_filespec != '' and history_days < 1:
+    print_line('ERROR: Invalid "history_days" found in configuration file: "config.ini"! Must be 1 or more. Fix and try again... Aborting', error=True, sd_notify=True)
+    sys.exit(1)
+
+# output sinks in addition to MQTT: a Prometheus scrape endpoint and/or a file, each report
+sink_http_port = 0
+sink_http_bind_address = '0.0.0.0'
+sink_filespec = ''
+sink_file_format = 'prometheus'
+if config.has_section('Sinks'):
+    sink_http_port = config['Sinks'].getint('http_port', 0)
+    sink_http_bind_address = config['Sinks'].get('http_bind_address', sink_http_bind_address)
+    sink_filespec = config['Sinks'].get('file_filespec', '')
+    sink_file_format = config['Sinks'].get('file_format', sink_file_format).lower()
+if sink_file_format not in ('prometheus', 'json'):
+    print_line('ERROR: Invalid "file_format" found in configuration file: "config.ini"! Must be [prometheus or json] Fix and try again... Aborting', error=True, sd_notify=True)
+    sys.exit(1)
+
+# OpenWrt ubus socket for system info/board (one IPC call instead of many shell pipelines)
+#  'auto' looks in the usual places, 'none' always uses the shell/proc probes
+UBUS_SOCKET_SPECS = ['/var/run/ubus/ubus.sock', '/var/run/ubus.sock']
+ubus_socket_setting = config['Daemon'].get('ubus_socket', 'auto')
+
+# MQTT protocol: '3.1.1' (default) or '5' (opt-in, falls back to 3.1.1 if the broker refuses)
+default_protocol = '3.1.1'
+
+# MQTT v5 only: have the broker hold our session this long so a reconnect can resume it
+default_session_expiry_in_seconds = 300
+
+# 'online' is published retained once per connection, periodic heartbeats are optional
+default_heartbeat_interval_in_seconds = 0
+
+# seconds to wait for a v5 CONNACK before assuming the broker won't speak v5
+MQTT_V5_CONNACK_TIMEOUT_IN_SECONDS = 10
+
+LOG_LEVELS = ['info', 'verbose', 'debug']
+
+def getAlertThresholds(config):
+    # returns (alert key -> (metric, mount, set value, clear value), error text)
+    alertThresholds = OrderedDict()
+    if not config.has_section('Alerts'):
+        return alertThresholds, ''
+    for [alertKey, alertSetting] in config['Alerts'].items():
+        if alertKey == 'sample_interval_in_seconds':
+            continue
+        alertMetric, _, alertMount = alertKey.partition('@')
+        if alertMetric not in (ALERT_FS_USED, ALERT_MEM_AVAIL, ALERT_LOAD) or (alertMount != '' and alertMetric != ALERT_FS_USED):
+            return None, 'Unknown alert "{}" found in configuration file: "config.ini"!'.format(alertKey)
+        try:
+            alertValues = [float(value) for value in alertSetting.split(',')]
+        except ValueError:
+            alertValues = []
+        if len(alertValues) == 1:
+            alertValues.append(alertValues[0])   # no hysteresis
+        isLowAlert = alertMetric in ALERT_LOW_METRICS
+        if len(alertValues) != 2 or (isLowAlert and alertValues[1] < alertValues[0]) or (not isLowAlert and alertValues[1] > alertValues[0]):
+            return None, 'Invalid alert "{}" found in configuration file: "config.ini"! Must be {{set}}, {{clear}} with clear {} set.'.format(alertKey, '>=' if isLowAlert else '<=')
+        alertThresholds[alertKey] = (alertMetric, alertMount, alertValues[0], alertValues[1])
+    return alertThresholds, ''
+
+def getBrokerSettings(config):
+    # everything that needs a new MQTT connection when changed
+    brokerSettings = OrderedDict()
+    brokerSettings['hostname'] = os.environ.get('MQTT_HOSTNAME', config['MQTT'].get('hostname', 'localhost'))
+    brokerSettings['port'] = int(os.environ.get('MQTT_PORT', config['MQTT'].get('port', '1883')))
+    brokerSettings['keepalive'] = config['MQTT'].getint('keepalive', 60)
+    brokerSettings['username'] = os.environ.get("MQTT_USERNAME", config['MQTT'].get('username'))
+    brokerSettings['password'] = os.environ.get("MQTT_PASSWORD", config['MQTT'].get('password', None))
+    brokerSettings['tls'] = config['MQTT'].getboolean('tls', False)
+    brokerSettings['tls_ca_cert'] = config['MQTT'].get('tls_ca_cert', None)
+    brokerSettings['tls_keyfile'] = config['MQTT'].get('tls_keyfile', None)
+    brokerSettings['tls_certfile'] = config['MQTT'].get('tls_certfile', None)
+    brokerSettings['tls_ciphers'] = config['MQTT'].get('tls_ciphers', None)
+    brokerSettings['protocol'] = config['MQTT'].get('protocol', default_protocol).strip()
+    brokerSettings['session_expiry_in_seconds'] = config['MQTT'].getint('session_expiry_in_seconds', default_session_expiry_in_seconds)
+    return brokerSettings
+
+def getReloadableSettings(config):
+    # read the settings we can change while running (see reloadConfiguration())
+    #  returns (settings, error text) - settings is None when the config is not acceptable
+    settings = OrderedDict()
+    try:
+        settings['interval_in_minutes'] = config['Daemon'].getint('interval_in_minutes', default_interval_in_minutes)
+        if (settings['interval_in_minutes'] < min_interval_in_minutes) or (settings['interval_in_minutes'] > max_interval_in_minutes):
+            return None, 'Invalid "interval_in_minutes" found in configuration file: "config.ini"! Must be [{}-{}]'.format(min_interval_in_minutes, max_interval_in_minutes)
+        settings['report_schedule'] = config['Daemon'].get('report_schedule', default_report_schedule).lower()
+        if settings['report_schedule'] not in REPORT_SCHEDULES:
+            return None, 'Invalid "report_schedule" found in configuration file: "config.ini"! Must be [{}]'.format(' or '.join(REPORT_SCHEDULES))
+        settings['log_level'] = config['Daemon'].get('log_level', LOG_LEVELS[0]).lower()
+        if settings['log_level'] not in LOG_LEVELS:
+            return None, 'Invalid "log_level" found in configuration file: "config.ini"! Must be [{}]'.format(', '.join(LOG_LEVELS))
+        settings['event_debounce_in_seconds'] = config['Daemon'].getint('event_debounce_in_seconds', default_event_debounce_in_seconds)
+        settings['collector_timeout_in_seconds'] = config['Daemon'].getint('collector_timeout_in_seconds', default_collector_timeout_in_seconds)
+        settings['throttle_load'] = config['Daemon'].getfloat('throttle_load', default_throttle_load)
+        settings['throttle_cpu_in_seconds'] = config['Daemon'].getfloat('throttle_cpu_in_seconds', default_throttle_cpu_in_seconds)
+        settings['max_interval_stretch'] = config['Daemon'].getint('max_interval_stretch', default_max_interval_stretch)
+        if settings['max_interval_stretch'] < 1:
+            return None, 'Invalid "max_interval_stretch" found in configuration file: "config.ini"! Must be 1 (never stretch) or more.'
+        settings['watchdog_timeout_in_seconds'] = config['Daemon'].getint('watchdog_timeout_in_seconds', default_watchdog_timeout_in_seconds)
+        settings['history_chunk_records'] = config['Daemon'].getint('history_chunk_records', default_history_chunk_records)
+        if settings['history_chunk_records'] < 1:
+            return None, 'Invalid "history_chunk_records" found in configuration file: "config.ini"! Must be 1 or more.'
+        settings['alert_sample_interval_in_seconds'] = default_alert_sample_interval_in_seconds
+        if config.has_section('Alerts'):
+            settings['alert_sample_interval_in_seconds'] = config['Alerts'].getint('sample_interval_in_seconds', default_alert_sample_interval_in_seconds)
+        settings['alert_thresholds'], alertError = getAlertThresholds(config)
+        if settings['alert_thresholds'] is None:
+            return None, alertError
+        settings['base_topic'] = config['MQTT'].get('base_topic', default_base_topic).lower()
+        settings['sensor_name'] = config['MQTT'].get('sensor_name', default_sensor_name).lower()
+        settings['heartbeat_interval_in_seconds'] = config['MQTT'].getint('heartbeat_interval_in_seconds', default_heartbeat_interval_in_seconds)
+        if settings['heartbeat_interval_in_seconds'] < 0:
+            return None, 'Invalid "heartbeat_interval_in_seconds" found in configuration file: "config.ini"! Must be 0 (none) or more.'
+        # MQTT v5 only: drop our monitor reports queued at the broker once they are older than this
+        settings['message_expiry_in_seconds'] = config['MQTT'].getint('message_expiry_in_seconds', settings['interval_in_minutes'] * 60)
+        settings['mqtt_broker'] = getBrokerSettings(config)
+        if settings['mqtt_broker']['protocol'] not in ('3.1.1', '5'):
+            return None, 'Invalid "protocol" found in configuration file: "config.ini"! Must be [3.1.1 or 5]'
+    except KeyError as missingSection:
+        return None, 'No {} settings found in configuration file "config.ini"!'.format(missingSection)
+    except ValueError as badValue:
+        return None, 'Invalid value found in configuration file: "config.ini"! ({})'.format(badValue)
+    return settings, ''
+
+def applyReloadableSettings(settings):
+    global reloadable_settings
+    global opt_verbose
+    global opt_debug
+    global interval_in_minutes
+    global report_schedule
+    global event_debounce_in_seconds
+    global collector_timeout_in_seconds
+    global throttle_load
+    global throttle_cpu_in_seconds
+    global max_interval_stretch
+    global interval_stretch
+    global watchdog_timeout_in_seconds
+    global history_chunk_records
+    global alert_sample_interval_in_seconds
+    global alert_thresholds
+    global config_base_topic
+    global config_sensor_name
+    global message_expiry_in_seconds
+    global heartbeat_interval_in_seconds
+    global mqtt_broker
+    reloadable_settings = settings
+    # command line -v/-d always win
+    opt_verbose = parse_args.verbose or settings['log_level'] != 'info'
+    opt_debug = parse_args.debug or settings['log_level'] == 'debug'
+    interval_in_minutes = settings['interval_in_minutes']
+    report_schedule = settings['report_schedule']
+    event_debounce_in_seconds = settings['event_debounce_in_seconds']
+    collector_timeout_in_seconds = settings['collector_timeout_in_seconds']
+    throttle_load = settings['throttle_load']
+    throttle_cpu_in_seconds = settings['throttle_cpu_in_seconds']
+    max_interval_stretch = settings['max_interval_stretch']
+    interval_stretch = min(interval_stretch, max_interval_stretch)
+    watchdog_timeout_in_seconds = settings['watchdog_timeout_in_seconds']
+    history_chunk_records = settings['history_chunk_records']
+    alert_sample_interval_in_seconds = settings['alert_sample_interval_in_seconds']
+    alert_thresholds = settings['alert_thresholds']
+    config_base_topic = settings['base_topic']
+    config_sensor_name = settings['sensor_name']
+    message_expiry_in_seconds = settings['message_expiry_in_seconds']
+    heartbeat_interval_in_seconds = settings['heartbeat_interval_in_seconds']
+    mqtt_broker = settings['mqtt_broker']
+
+# our current interval multiplier (1 = normal cadence, see throttleCycle())
+interval_stretch = 1
 
 # Check configuration
 #
-if (interval_in_minutes < min_interval_in_minutes) or (interval_in_minutes > max_interval_in_minutes):
-    print_line('ERROR: Invalid "interval_in_minutes" found in configuration file: "config.ini"! Must be [{}-{}] Fix and try again... Aborting'.format(min_interval_in_minutes, max_interval_in_minutes), error=True, sd_notify=True)
+reloadable_settings, config_error = getReloadableSettings(config)
+if reloadable_settings is None:
+    print_line('ERROR: {} Fix and try again... Aborting'.format(config_error), error=True, sd_notify=True)
     sys.exit(1)
+applyReloadableSettings(reloadable_settings)
+mqtt_protocol = mqtt.MQTTv5 if mqtt_broker['protocol'] == '5' else mqtt.MQTTv311
 
 ### Ensure required values within sections of our config are present
 if not config['MQTT']:
@@ -201,6 +506,123 @@ dvc_filesystem = []
 dvc_memory_tuple = ''
 # Tuple (Hardware, Model Name, NbrCores, BogoMIPS)
 dvc_cpu_tuple = ''
+dvc_firmware_version = ''
+dvc_processor_family = ''
+# collectors whose last run timed out (so their values are from an earlier run)
+dvc_stale_collectors = set()
+
+# -----------------------------------------------------------------------------
+#  low impact mode: lower our CPU and IO priority
+# -----------------------------------------------------------------------------
+
+LOW_IMPACT_NICE_INCREMENT = 10
+
+# ioprio_set() syscall numbers, no python wrapper exists
+IOPRIO_SET_SYSCALLS = OrderedDict([('mips', 4314), ('x86_64', 251), ('i686', 289), ('i386', 289), ('aarch64', 30), ('arm', 314)])
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_BE_LOWEST = 7
+
+def setLowImpactPriority():
+    # must run before we start threads or commands, they inherit our priorities
+    os.nice(LOW_IMPACT_NICE_INCREMENT)
+    ioprioSyscall = 0
+    for [machinePrefix, syscallNbr] in IOPRIO_SET_SYSCALLS.items():
+        if os.uname().machine.startswith(machinePrefix):
+            ioprioSyscall = syscallNbr
+            break
+    ioprioSet = False
+    libcName = ctypes.util.find_library('c')
+    if ioprioSyscall != 0 and libcName is not None:
+        libc = ctypes.CDLL(libcName, use_errno=True)
+        ioprioSet = libc.syscall(ioprioSyscall, IOPRIO_WHO_PROCESS, 0, (IOPRIO_CLASS_BE << IOPRIO_CLASS_SHIFT) | IOPRIO_BE_LOWEST) == 0
+    if not ioprioSet:
+        # IO priority then follows our (now lower) nice level
+        print_line('Low impact: could not set our IO priority on [{}], it follows our nice level'.format(os.uname().machine), warning=True)
+    print_line('Low impact: running at nice {}'.format(os.nice(0)), verbose=True)
+
+if low_impact_enabled:
+    setLowImpactPriority()
+
+# -----------------------------------------------------------------------------
+#  collector deadline handling
+# -----------------------------------------------------------------------------
+
+class CollectorTimeoutError(Exception):
+    pass
+
+# collector name -> nbr of times it ran past its deadline
+collector_timeout_counts = OrderedDict()
+
+# command -> its process that ran past our deadline and has not been reaped yet
+hung_processes = {}
+
+def runCommand(command):
+    # run shell command for a collector, giving up after our collector deadline
+    hungProcess = hung_processes.get(command)
+    if hungProcess is not None:
+        if hungProcess.poll() is None:
+            # a 'df' stuck on a dead NFS mount can't be killed, don't pile up another one
+            raise CollectorTimeoutError('{} (still running since an earlier report)'.format(command))
+        del hung_processes[command]
+    process = subprocess.Popen(command,
+           shell=True,
+           stdout=subprocess.PIPE,
+           stderr=subprocess.STDOUT,
+           start_new_session=True)
+    try:
+        stdout, _ = process.communicate(timeout=collector_timeout_in_seconds)
+    except subprocess.TimeoutExpired:
+        try:
+            os.killpg(process.pid, SIGKILL)     # the whole pipeline, not just the shell
+        except OSError:
+            pass
+        # may not die right away (uninterruptible sleep), we reap it on our next run
+        hung_processes[command] = process
+        raise CollectorTimeoutError(command)
+    return stdout
+
+def runCollector(collector):
+    # run a collector, on timeout keep its last known values and mark them stale
+    #  returns the time (seconds) the collector took
+    collectorName = collector.__name__
+    startTime = time()
+    try:
+        collector()
+    except CollectorTimeoutError as timedOutCmd:
+        collector_timeout_counts[collectorName] = collector_timeout_counts.get(collectorName, 0) + 1
+        dvc_stale_collectors.add(collectorName)
+        print_line('{}() timed out after {} seconds running [{}], reporting last known value'.format(collectorName, collector_timeout_in_seconds, timedOutCmd), warning=True)
+    else:
+        dvc_stale_collectors.discard(collectorName)
+    return time() - startTime
+
+# our collector worker pool, threads are reused from cycle to cycle
+collector_pool = concurrent.futures.ThreadPoolExecutor(max_workers=collector_workers)
+
+def runCollectors(collectorDependencies):
+    # run collectors on our worker pool, each as soon as the collectors it depends on are done
+    #  collectorDependencies: OrderedDict collector -> [collectors it must run after]
+    #  returns the summed time (seconds) of all collectors run
+    pending = OrderedDict(collectorDependencies)
+    finished = set()
+    running = {}    # future -> collector
+    collectorsTime = 0.0
+    while len(pending) > 0 or len(running) > 0:
+        for collector in list(pending):
+            # dependencies on collectors not run this time are treated as satisfied
+            if all(dependency in finished or dependency not in collectorDependencies for dependency in pending[collector]):
+                del pending[collector]
+                running[collector_pool.submit(runCollector, collector)] = collector
+        if len(running) == 0:
+            print_line('runCollectors() unresolvable dependencies, NOT run: {}'.format([collector.__name__ for collector in pending]), error=True)
+            break
+        doneFutures, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in doneFutures:
+            finished.add(running.pop(future))
+            collectorsTime += future.result()
+    return collectorsTime
 
 # -----------------------------------------------------------------------------
 #  monitor variable fetch routines
@@ -212,11 +634,7 @@ def getDeviceCpuInfo():
     #  machine                 : Onion Omega2+
     #  cpu model               : MIPS 24KEc V5.5
     #  BogoMIPS                : 385.84
-    out = subprocess.Popen("cat /proc/cpuinfo | egrep -i 'system|cpu|bogo'",
-           shell=True,
-           stdout=subprocess.PIPE,
-           stderr=subprocess.STDOUT)
-    stdout, _ = out.communicate()
+    stdout = runCommand("cat /proc/cpuinfo | egrep -i 'system|cpu|bogo'")
     lines = stdout.decode('utf-8').split("\n")
     trimmedLines = []
     for currLine in lines:
@@ -244,11 +662,7 @@ def getDeviceMemory():
     #  MemTotal:         124808 kB
     #  MemFree:           45264 kB
     #  MemAvailable:      41640 kB
-    out = subprocess.Popen("cat /proc/meminfo | egrep -i 'mem[tfa]'",
-           shell=True,
-           stdout=subprocess.PIPE,
-           stderr=subprocess.STDOUT)
-    stdout, _ = out.communicate()
+    stdout = runCommand("cat /proc/meminfo | egrep -i 'mem[tfa]'")
     lines = stdout.decode('utf-8').split("\n")
     trimmedLines = []
     for currLine in lines:
@@ -273,11 +687,7 @@ def getDeviceModel():
     global dvc_model
     global dvc_model_raw
     global dvc_connections
-    out = subprocess.Popen("cat /proc/cpuinfo | grep machine",
-           shell=True,
-           stdout=subprocess.PIPE,
-           stderr=subprocess.STDOUT)
-    stdout, _ = out.communicate()
+    stdout = runCommand("cat /proc/cpuinfo | grep machine")
     dvc_model_raw = stdout.decode('utf-8').lstrip().rstrip()
     # now reduce string length (just more compact, same info)
     lineParts = dvc_model_raw.split(':')
@@ -300,11 +710,7 @@ def getLinuxRelease():
 
 def getLinuxVersion():
     global dvc_linux_version
-    out = subprocess.Popen("/bin/uname -r",
-           shell=True,
-           stdout=subprocess.PIPE,
-           stderr=subprocess.STDOUT)
-    stdout, _ = out.communicate()
+    stdout = runCommand("/bin/uname -r")
     dvc_linux_version = stdout.decode('utf-8').rstrip()
     print_line('dvc_linux_version=[{}]'.format(dvc_linux_version), debug=True)
 
@@ -312,11 +718,7 @@ def getHostnames():
     global dvc_hostname
     global dvc_fqdn
     #  BUG?! our Omega2 doesn't know our domain name so we append it
-    out = subprocess.Popen("/bin/cat /etc/config/system | /bin/grep host | /usr/bin/awk '{ print $3 }'",
-           shell=True,
-           stdout=subprocess.PIPE,
-           stderr=subprocess.STDOUT)
-    stdout, _ = out.communicate()
+    stdout = runCommand("/bin/cat /etc/config/system | /bin/grep host | /usr/bin/awk '{ print $3 }'")
     dvc_hostname = stdout.decode('utf-8').rstrip().replace("'", '')
     print_line('dvc_hostname=[{}]'.format(dvc_hostname), debug=True)
     if len(fallback_domain) > 0:
@@ -328,11 +730,7 @@ def getHostnames():
 def getUptime():    # RERUN in loop
     global dvc_uptime_raw
     global dvc_uptime
-    out = subprocess.Popen("/usr/bin/uptime",
-           shell=True,
-           stdout=subprocess.PIPE,
-           stderr=subprocess.STDOUT)
-    stdout, _ = out.communicate()
+    stdout = runCommand("/usr/bin/uptime")
     dvc_uptime_raw = stdout.decode('utf-8').rstrip().lstrip()
     print_line('dvc_uptime_raw=[{}]'.format(dvc_uptime_raw), debug=True)
     basicParts = dvc_uptime_raw.split()
@@ -350,11 +748,7 @@ def getUptime():    # RERUN in loop
 def getNetworkIFs():    # RERUN in loop
     global dvc_interfaces
     global dvc_mac_raw
-    out = subprocess.Popen('/sbin/ifconfig | egrep "Link|flags|inet|ether" | egrep -v -i "lo:|loopback|inet6|\:\:1|127\.0\.0\.1"',
-           shell=True,
-           stdout=subprocess.PIPE,
-           stderr=subprocess.STDOUT)
-    stdout, _ = out.communicate()
+    stdout = runCommand('/sbin/ifconfig | egrep "Link|flags|inet|ether" | egrep -v -i "lo:|loopback|inet6|\:\:1|127\.0\.0\.1"')
     lines = stdout.decode('utf-8').split("\n")
     trimmedLines = []
     for currLine in lines:
@@ -415,11 +809,7 @@ def getFileSystemDrives():
     global dvc_filesystem_space
     global dvc_filesystem_percent
     global dvc_filesystem
-    out = subprocess.Popen("/bin/df -m | /usr/bin/tail -n +2 | /bin/egrep -v 'tmpfs|boot|mmcblk|mtdblock|/rom'",
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT)
-    stdout, _ = out.communicate()
+    stdout = runCommand("/bin/df -m | /usr/bin/tail -n +2 | /bin/egrep -v 'tmpfs|boot|mmcblk|mtdblock|/rom'")
     lines = stdout.decode('utf-8').split("\n")
     trimmedLines = []
     for currLine in lines:
@@ -481,10 +871,12 @@ def getSystemTemperature():
     global dvc_system_temp
     dvc_system_temp = 'n/a'    # NOT avial on Omega2
 
-def getLastUpdateDate():    # RERUN in loop
+opkg_log_filespec = '/var/opkg-lists/omega2_base.sig'
+oupgrade_log_filespec = '/var/oupgrade.log'
+
+def getLastUpdateDate():    # RERUN in loop (unless watched by inotify)
     global dvc_last_update_date
     global dvc_last_fw_check_date
-    opkg_log_filespec = '/var/opkg-lists/omega2_base.sig'
     try:
         mtime = os.path.getmtime(opkg_log_filespec)
     except OSError:
@@ -493,7 +885,6 @@ def getLastUpdateDate():    # RERUN in loop
     dvc_last_update_date  = last_modified_date
     print_line('dvc_last_update_date=[{}]'.format(dvc_last_update_date), debug=True)
 
-    oupgrade_log_filespec = '/var/oupgrade.log'
     try:
         mtime = os.path.getmtime(oupgrade_log_filespec)
     except OSError:
@@ -504,11 +895,7 @@ def getLastUpdateDate():    # RERUN in loop
 
 def getFirmwareVersion():
     global dvc_firmware_version
-    out = subprocess.Popen("/usr/bin/oupgrade -v | tr -d '>'",
-           shell=True,
-           stdout=subprocess.PIPE,
-           stderr=subprocess.STDOUT)
-    stdout, _ = out.communicate()
+    stdout = runCommand("/usr/bin/oupgrade -v | tr -d '>'")
     fw_version_raw = stdout.decode('utf-8').rstrip()
     lineParts = fw_version_raw.split(':')
     dvc_firmware_version = lineParts[1].lstrip()
@@ -516,26 +903,247 @@ def getFirmwareVersion():
 
 def getProcessorType():
     global dvc_processor_family
-    out = subprocess.Popen("/bin/uname -m",
-           shell=True,
-           stdout=subprocess.PIPE,
-           stderr=subprocess.STDOUT)
-    stdout, _ = out.communicate()
+    stdout = runCommand("/bin/uname -m")
     dvc_processor_family = stdout.decode('utf-8').rstrip()
     print_line('dvc_processor_family=[{}]'.format(dvc_processor_family), debug=True)
 
 
-# get model so we can use it too in MQTT
-getDeviceModel()
-getFirmwareVersion()
-# get our hostnames so we can setup MQTT
-getHostnames()
-getDeviceCpuInfo()
-getProcessorType()
+# -----------------------------------------------------------------------------
+#  ubus (OpenWrt system bus) collectors, talking to ubusd's socket directly
+# -----------------------------------------------------------------------------
+
+class UbusError(Exception):
+    pass
+
+# ubus message types and attributes (libubus ubusmsg.h)
+UBUS_MSG_HELLO = 0
+UBUS_MSG_STATUS = 1
+UBUS_MSG_DATA = 2
+UBUS_MSG_LOOKUP = 4
+UBUS_MSG_INVOKE = 5
+UBUS_ATTR_STATUS = 1
+UBUS_ATTR_OBJPATH = 2
+UBUS_ATTR_OBJID = 3
+UBUS_ATTR_METHOD = 4
+UBUS_ATTR_DATA = 7
+UBUS_MSG_HDR = struct.Struct('>BBHI')       # version, type, seq, peer
+
+# blob/blobmsg encoding (libubox blob.h, blobmsg.h)
+BLOB_ATTR_EXTENDED = 0x80000000
+BLOB_ATTR_ID_MASK = 0x7f000000
+BLOB_ATTR_ID_SHIFT = 24
+BLOB_ATTR_LEN_MASK = 0x00ffffff
+BLOBMSG_TYPE_ARRAY = 1
+BLOBMSG_TYPE_TABLE = 2
+BLOBMSG_TYPE_STRING = 3
+BLOBMSG_TYPE_INT64 = 4
+BLOBMSG_TYPE_INT32 = 5
+BLOBMSG_TYPE_INT16 = 6
+BLOBMSG_TYPE_INT8 = 7
+BLOBMSG_TYPE_DOUBLE = 8
+
+def blobPadLen(length):
+    return (length + 3) & ~3
+
+def blobAttr(attrId, payload):
+    length = 4 + len(payload)
+    return struct.pack('>I', (attrId << BLOB_ATTR_ID_SHIFT) | length) + payload + b'\0' * (blobPadLen(length) - length)
+
+def parseBlobAttrs(buffer):
+    # return list of (id, extended, payload)
+    attrs = []
+    offset = 0
+    while offset + 4 <= len(buffer):
+        header = struct.unpack_from('>I', buffer, offset)[0]
+        length = header & BLOB_ATTR_LEN_MASK
+        if length < 4 or offset + length > len(buffer):
+            raise UbusError('malformed blob attribute')
+        attrs.append(((header & BLOB_ATTR_ID_MASK) >> BLOB_ATTR_ID_SHIFT, (header & BLOB_ATTR_EXTENDED) != 0, buffer[offset + 4:offset + length]))
+        offset += blobPadLen(length)
+    return attrs
+
+def parseBlobmsgValue(msgType, value):
+    if msgType == BLOBMSG_TYPE_TABLE:
+        return parseBlobmsgTable(value)
+    if msgType == BLOBMSG_TYPE_ARRAY:
+        return list(parseBlobmsgTable(value).values())
+    if msgType == BLOBMSG_TYPE_STRING:
+        return value.rstrip(b'\0').decode('utf-8', 'replace')
+    if msgType == BLOBMSG_TYPE_INT64:
+        return struct.unpack('>q', value[:8])[0]
+    if msgType == BLOBMSG_TYPE_INT32:
+        return struct.unpack('>i', value[:4])[0]
+    if msgType == BLOBMSG_TYPE_INT16:
+        return struct.unpack('>h', value[:2])[0]
+    if msgType == BLOBMSG_TYPE_INT8:
+        return value[0]
+    if msgType == BLOBMSG_TYPE_DOUBLE:
+        return struct.unpack('>d', value[:8])[0]
+    return None
+
+def parseBlobmsgTable(buffer):
+    table = OrderedDict()
+    for [msgType, _, payload] in parseBlobAttrs(buffer):
+        nameLen = struct.unpack_from('>H', payload, 0)[0]
+        name = payload[2:2 + nameLen].decode('utf-8', 'replace')
+        valueOffset = blobPadLen(2 + nameLen + 1)
+        if name == '':
+            name = str(len(table))     # array entries have no names
+        table[name] = parseBlobmsgValue(msgType, payload[valueOffset:])
+    return table
+
+def sendUbusMessage(ubusSocket, msgType, seq, peer, attrs):
+    ubusSocket.sendall(UBUS_MSG_HDR.pack(0, msgType, seq, peer) + blobAttr(0, b''.join(attrs)))
+
+def recvExactly(ubusSocket, nbrBytes):
+    data = b''
+    while len(data) < nbrBytes:
+        chunk = ubusSocket.recv(nbrBytes - len(data))
+        if len(chunk) == 0:
+            raise UbusError('ubusd closed the connection')
+        data += chunk
+    return data
+
+def recvUbusMessage(ubusSocket):
+    # return (type, seq, {attr id: payload})
+    header = recvExactly(ubusSocket, UBUS_MSG_HDR.size + 4)
+    _, msgType, seq, _ = UBUS_MSG_HDR.unpack_from(header, 0)
+    length = struct.unpack_from('>I', header, UBUS_MSG_HDR.size)[0] & BLOB_ATTR_LEN_MASK
+    body = recvExactly(ubusSocket, length - 4) if length > 4 else b''
+    attrs = OrderedDict()
+    for [attrId, _, payload] in parseBlobAttrs(body):
+        attrs[attrId] = payload
+    return msgType, seq, attrs
+
+def ubusRequest(ubusSocket, msgType, seq, peer, attrs):
+    # send a request, return the payloads of its DATA replies once its STATUS says ok
+    sendUbusMessage(ubusSocket, msgType, seq, peer, attrs)
+    replies = []
+    while True:
+        replyType, replySeq, replyAttrs = recvUbusMessage(ubusSocket)
+        if replySeq != seq:
+            continue
+        if replyType == UBUS_MSG_DATA:
+            replies.append(replyAttrs)
+        elif replyType == UBUS_MSG_STATUS:
+            status = struct.unpack('>i', replyAttrs.get(UBUS_ATTR_STATUS, b'\0\0\0\0')[:4])[0]
+            if status != 0:
+                raise UbusError('ubus status {}'.format(status))
+            return replies
+
+def ubusCall(objectPath, method):
+    # same as 'ubus call {objectPath} {method}' (w/o arguments), returns the reply table
+    ubusSocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    ubusSocket.settimeout(collector_timeout_in_seconds)
+    try:
+        ubusSocket.connect(ubus_socket_spec)
+        helloType, _, _ = recvUbusMessage(ubusSocket)
+        if helloType != UBUS_MSG_HELLO:
+            raise UbusError('no hello from ubusd')
+        lookupReplies = ubusRequest(ubusSocket, UBUS_MSG_LOOKUP, 1, 0, [blobAttr(UBUS_ATTR_OBJPATH, objectPath.encode('utf-8') + b'\0')])
+        if len(lookupReplies) == 0 or UBUS_ATTR_OBJID not in lookupReplies[0]:
+            raise UbusError('ubus object "{}" not found'.format(objectPath))
+        objectID = struct.unpack('>I', lookupReplies[0][UBUS_ATTR_OBJID][:4])[0]
+        invokeReplies = ubusRequest(ubusSocket, UBUS_MSG_INVOKE, 2, objectID, [
+            blobAttr(UBUS_ATTR_OBJID, struct.pack('>I', objectID)),
+            blobAttr(UBUS_ATTR_METHOD, method.encode('utf-8') + b'\0'),
+            blobAttr(UBUS_ATTR_DATA, b'')])
+    except socket.timeout:
+        raise CollectorTimeoutError('ubus call {} {}'.format(objectPath, method))
+    except (OSError, struct.error) as ubusErr:
+        raise UbusError(str(ubusErr))
+    finally:
+        ubusSocket.close()
+    for reply in invokeReplies:
+        if UBUS_ATTR_DATA in reply:
+            return parseBlobmsgTable(reply[UBUS_ATTR_DATA])
+    return OrderedDict()
+
+def findUbusSocket():
+    if ubus_socket_setting == 'none':
+        return ''
+    if ubus_socket_setting != 'auto':
+        return ubus_socket_setting
+    for socketSpec in UBUS_SOCKET_SPECS:
+        if os.path.exists(socketSpec):
+            return socketSpec
+    return ''
+
+# '' when we use the shell/proc probes instead of ubus
+ubus_socket_spec = findUbusSocket()
+
+def formatUptime(uptimeSeconds):
+    # same form as we get from 'uptime': "12 min", "3:25" or "14 days"
+    uptimeDays = uptimeSeconds // 86400
+    if uptimeDays > 0:
+        return '{} day{}'.format(uptimeDays, '' if uptimeDays == 1 else 's')
+    uptimeHours = (uptimeSeconds % 86400) // 3600
+    uptimeMinutes = (uptimeSeconds % 3600) // 60
+    if uptimeHours > 0:
+        return '{}:{:02d}'.format(uptimeHours, uptimeMinutes)
+    return '{} min'.format(uptimeMinutes)
+
+def getUbusSystemBoard():
+    # model, hostnames, os release and version in one call (falls back to the shell probes)
+    global ubus_socket_spec
+    global dvc_model_raw
+    global dvc_model
+    global dvc_connections
+    global dvc_hostname
+    global dvc_fqdn
+    global dvc_linux_release
+    global dvc_linux_version
+    if ubus_socket_spec != '':
+        try:
+            boardInfo = ubusCall('system', 'board')
+        except UbusError as ubusErr:
+            # e.g. no ubusd or our user is not allowed by its ACLs, don't try again
+            print_line('ubus [{}] not usable ({}), using shell/proc probes'.format(ubus_socket_spec, ubusErr), warning=True)
+            ubus_socket_spec = ''
+        else:
+            dvc_model_raw = boardInfo.get('model', '')
+            dvc_model = dvc_model_raw
+            dvc_connections = 'w' # default
+            dvc_hostname = boardInfo.get('hostname', '')
+            if len(fallback_domain) > 0:
+                dvc_fqdn = '{}.{}'.format(dvc_hostname, fallback_domain)
+            else:
+                dvc_fqdn = dvc_hostname
+            dvc_linux_release = boardInfo.get('release', {}).get('distribution', 'OpenWrt')
+            dvc_linux_version = boardInfo.get('kernel', '')
+            print_line('ubus system board: dvc_model=[{}], dvc_hostname=[{}], dvc_linux_release=[{}], dvc_linux_version=[{}]'.format(dvc_model, dvc_hostname, dvc_linux_release, dvc_linux_version), debug=True)
+            return
+    getDeviceModel()
+    getHostnames()
+    getLinuxRelease()
+    getLinuxVersion()
+
+def getUbusSystemInfo():    # RERUN in loop
+    # uptime and memory in one call (falls back to the shell/proc probes)
+    global dvc_uptime
+    global dvc_memory_tuple
+    if ubus_socket_spec != '':
+        try:
+            systemInfo = ubusCall('system', 'info')
+        except UbusError as ubusErr:
+            print_line('ubus system info failed ({}), using shell/proc probes this time'.format(ubusErr), warning=True)
+        else:
+            dvc_uptime = formatUptime(systemInfo.get('uptime', 0))
+            memoryInfo = systemInfo.get('memory', {})
+            # Tuple (Total, Free, Avail.)
+            dvc_memory_tuple = ( memoryInfo.get('total', 0) / 1048576, memoryInfo.get('free', 0) / 1048576, memoryInfo.get('available', memoryInfo.get('free', 0)) / 1048576 )
+            print_line('ubus system info: dvc_uptime=[{}], dvc_memory_tuple=[{}]'.format(dvc_uptime, dvc_memory_tuple), debug=True)
+            return
+    getUptime()
+    getDeviceMemory()
+
+# get model and our hostnames so we can use them in MQTT
+runCollector(getUbusSystemBoard)
+runCollector(getFirmwareVersion)
+runCollector(getDeviceCpuInfo)
+runCollector(getProcessorType)
 getLastUpdateDate()
-getLinuxRelease()
-getLinuxVersion()
-getNetworkIFs()
+runCollector(getNetworkIFs)
 
 
 
@@ -543,25 +1151,46 @@ getNetworkIFs()
 #  timer and timer funcs for ALIVE MQTT Notices handling
 # -----------------------------------------------------------------------------
 
-ALIVE_TIMOUT_IN_SECONDS = 60
+HEARTBEAT_COMMAND = 'heartbeat'
+
+# heartbeats (timer or requested) sent, the 'online' of each new connection is not one
+heartbeat_count = 0
+heartbeat_times = deque()   # send times of those within the last hour
 
 def publishAliveStatus():
     print_line('- SEND: yes, still alive -', debug=True)
-    mqtt_client.publish(lwt_topic, payload=lwt_online_val, retain=False)
+    publishToTopic(lwt_topic, lwt_online_val, retain=True)
+
+def sendHeartbeat():
+    global heartbeat_count
+    heartbeat_count += 1
+    heartbeat_times.append(time())
+    publishAliveStatus()
 
 def aliveTimeoutHandler():
     print_line('- MQTT TIMER INTERRUPT -', debug=True)
-    _thread.start_new_thread(publishAliveStatus, ())
+    _thread.start_new_thread(sendHeartbeat, ())
     startAliveTimer()
 
+def handleHeartbeatRequest(payload):
+    _thread.start_new_thread(sendHeartbeat, ())
+
+def getHeartbeatsPerHour():
+    # heartbeats actually sent during the last hour
+    while len(heartbeat_times) > 0 and time() - heartbeat_times[0] > 3600:
+        heartbeat_times.popleft()
+    return len(heartbeat_times)
+
 def startAliveTimer():
     global aliveTimer
     global aliveTimerRunningStatus
     stopAliveTimer()
-    aliveTimer = threading.Timer(ALIVE_TIMOUT_IN_SECONDS, aliveTimeoutHandler)
+    if heartbeat_interval_in_seconds == 0:
+        return  # our retained 'online', LWT and MQTT keepalive tell our state
+    aliveTimer = threading.Timer(heartbeat_interval_in_seconds, aliveTimeoutHandler)
     aliveTimer.start()
     aliveTimerRunningStatus = True
-    print_line('- started MQTT timer - every {} seconds'.format(ALIVE_TIMOUT_IN_SECONDS), debug=True)
+    print_line('- started MQTT timer - every {} seconds'.format(heartbeat_interval_in_seconds), debug=True)
 
 def stopAliveTimer():
     global aliveTimer
@@ -575,7 +1204,7 @@ def isAliveTimerRunning():
     return aliveTimerRunningStatus
 
 # our ALIVE TIMER
-aliveTimer = threading.Timer(ALIVE_TIMOUT_IN_SECONDS, aliveTimeoutHandler)
+aliveTimer = threading.Timer(heartbeat_interval_in_seconds, aliveTimeoutHandler)
 # our BOOL tracking state of ALIVE TIMER
 aliveTimerRunningStatus = False
 
@@ -585,53 +1214,213 @@ aliveTimerRunningStatus = False
 #  MQTT setup and startup
 # -----------------------------------------------------------------------------
 
-# MQTT connection
-if sensor_name == default_sensor_name:
-    sensor_name = 'dvc-{}'.format(dvc_hostname.lower())
-lwt_topic = '{}/sensor/{}/status'.format(base_topic, sensor_name.lower())
-lwt_online_val = 'online'
-lwt_offline_val = 'offline'
-
-print_line('Connecting to MQTT broker ...', verbose=True)
-mqtt_client = mqtt.Client()
-mqtt_client.on_connect = on_connect
-mqtt_client.on_publish = on_publish
-mqtt_client.on_log = on_log
-
-mqtt_client.will_set(lwt_topic, payload=lwt_offline_val, retain=True)
-
-if config['MQTT'].getboolean('tls', False):
-    # According to the docs, setting PROTOCOL_SSLv23 "Selects the highest protocol version
-    # that both the client and server support. Despite the name, this option can select
-    # “TLS” protocols as well as “SSL”" - so this seems like a resonable default
-    mqtt_client.tls_set(
-        ca_certs=config['MQTT'].get('tls_ca_cert', None),
-        keyfile=config['MQTT'].get('tls_keyfile', None),
-        certfile=config['MQTT'].get('tls_certfile', None),
-        tls_version=ssl.PROTOCOL_SSLv23
-    )
-
-mqtt_username = os.environ.get("MQTT_USERNAME", config['MQTT'].get('username'))
-mqtt_password = os.environ.get("MQTT_PASSWORD", config['MQTT'].get('password', None))
-
-if mqtt_username:
-    mqtt_client.username_pw_set(mqtt_username, mqtt_password)
-try:
-    mqtt_client.connect(os.environ.get('MQTT_HOSTNAME', config['MQTT'].get('hostname', 'localhost')),
-                        port=int(os.environ.get('MQTT_PORT', config['MQTT'].get('port', '1883'))),
-                        keepalive=config['MQTT'].getint('keepalive', 60))
-except:
-    print_line('MQTT connection error. Please check your settings in the configuration file "config.ini"', error=True, sd_notify=True)
-    sys.exit(1)
-else:
-    mqtt_client.publish(lwt_topic, payload=lwt_online_val, retain=False)
+# MQTT v5 topic aliases for the topics we publish every cycle
+TOPIC_ALIAS_MONITOR = 1
+TOPIC_ALIAS_STATUS = 2
+mqtt_topic_aliases = {}
+
+def publishToTopic(topic, payload, qos=0, retain=False, expiry_in_seconds=0):
+    # publish, using MQTT v5 topic-alias and message-expiry when we are speaking v5
+    if mqtt_protocol != mqtt.MQTTv5:
+        return mqtt_client.publish(topic, payload, qos, retain=retain)
+    properties = Properties(PacketTypes.PUBLISH)
+    if expiry_in_seconds > 0:
+        properties.MessageExpiryInterval = expiry_in_seconds
+    alias = mqtt_topic_aliases.get(topic, 0)
+    if alias == 0 or alias > mqtt_topic_alias_max or not mqtt_client_connected:
+        if properties.isEmpty():
+            properties = None
+        return mqtt_client.publish(topic, payload, qos, retain=retain, properties=properties)
+    properties.TopicAlias = alias
+    with mqtt_topic_aliases_lock:
+        # QoS 1+ messages are resent as stored after a reconnect, when the broker no longer
+        #  knows our alias, so those always carry the full topic
+        if qos == 0 and topic in mqtt_topic_aliases_sent:
+            return mqtt_client.publish('', payload, qos, retain=retain, properties=properties)
+        messageInfo = mqtt_client.publish(topic, payload, qos, retain=retain, properties=properties)
+        if messageInfo.rc == mqtt.MQTT_ERR_SUCCESS:
+            mqtt_topic_aliases_sent.add(topic)     # broker now maps the alias to this topic
+        return messageInfo
+
+# TLS: one context for all our connections so each reconnect can resume our last session
+#  (a full handshake is slow on the Omega2's MIPS w/o crypto acceleration)
+tls_context = None
+tls_context_settings = None
+tls_session = None
+tls_handshake_count = 0
+tls_resumed_count = 0
+tls_last_handshake_in_seconds = 0.0
+
+class ResumingSSLContext(ssl.SSLContext):
+    # hands our cached session to each new connection (paho does the wrapping)
+    def wrap_socket(self, sock, **kwargs):
+        if tls_session is not None:
+            kwargs['session'] = tls_session
+        return super().wrap_socket(sock, **kwargs)
+
+class TimedSSLSocket(ssl.SSLSocket):
+    def do_handshake(self, *args, **kwargs):
+        global tls_handshake_count
+        global tls_resumed_count
+        global tls_last_handshake_in_seconds
+        startTime = time()
+        super().do_handshake(*args, **kwargs)
+        tls_last_handshake_in_seconds = time() - startTime
+        tls_handshake_count += 1
+        if self.session_reused:
+            tls_resumed_count += 1
+        print_line('TLS handshake took {:.3f} sec ({}, {})'.format(tls_last_handshake_in_seconds, 'resumed' if self.session_reused else 'full', self.cipher()[0]), debug=True)
+
+def getTlsContext():
+    # (re)build our context only when the TLS settings change, our session is only good with it
+    global tls_context
+    global tls_context_settings
+    global tls_session
+    contextSettings = tuple(mqtt_broker[settingKey] for settingKey in ['hostname', 'port', 'tls_ca_cert', 'tls_keyfile', 'tls_certfile', 'tls_ciphers'])
+    if tls_context is None or contextSettings != tls_context_settings:
+        # According to the docs, setting PROTOCOL_SSLv23 "Selects the highest protocol version
+        # that both the client and server support. Despite the name, this option can select
+        # “TLS” protocols as well as “SSL”" - so this seems like a resonable default
+        tls_context = ResumingSSLContext(ssl.PROTOCOL_SSLv23)
+        tls_context.sslsocket_class = TimedSSLSocket
+        if mqtt_broker['tls_certfile']:
+            tls_context.load_cert_chain(mqtt_broker['tls_certfile'], mqtt_broker['tls_keyfile'])
+        tls_context.verify_mode = ssl.CERT_REQUIRED
+        tls_context.check_hostname = True
+        if mqtt_broker['tls_ca_cert']:
+            tls_context.load_verify_locations(mqtt_broker['tls_ca_cert'])
+        else:
+            tls_context.load_default_certs()
+        if mqtt_broker['tls_ciphers']:
+            tls_context.set_ciphers(mqtt_broker['tls_ciphers'])
+        tls_context_settings = contextSettings
+        tls_session = None
+    return tls_context
+
+def saveTlsSession(client):
+    # keep the session (ticket) of our accepted connection for the next connect
+    #  (by now a TLS 1.3 ticket arrived, it follows the handshake)
+    global tls_session
+    clientSocket = client.socket()
+    if isinstance(clientSocket, ssl.SSLSocket) and clientSocket.session is not None:
+        tls_session = clientSocket.session
+
+def getTlsStatsDictionary():
+    tlsDict = OrderedDict()
+    tlsDict[RPT_TLS_HANDSHAKE_MS] = int(tls_last_handshake_in_seconds * 1000)
+    tlsDict[RPT_TLS_HANDSHAKES] = tls_handshake_count
+    tlsDict[RPT_TLS_RESUMED] = tls_resumed_count
+    return tlsDict
+
+def createMqttClient():
+    if mqtt_protocol == mqtt.MQTTv5:
+        client = mqtt.Client(protocol=mqtt.MQTTv5)
+    else:
+        client = mqtt.Client()
+    client.on_connect = on_connect
+    client.on_disconnect = on_disconnect
+    client.on_publish = on_publish
+    client.on_message = on_message
+    client.on_log = on_log
+
+    client.will_set(lwt_topic, payload=lwt_offline_val, retain=True)
+
+    if mqtt_broker['tls']:
+        client.tls_set_context(getTlsContext())
+
+    if mqtt_broker['username']:
+        client.username_pw_set(mqtt_broker['username'], mqtt_broker['password'])
+    return client
+
+def connectMqttClient(client):
+    hostname = mqtt_broker['hostname']
+    port = mqtt_broker['port']
+    keepalive = mqtt_broker['keepalive']
+    if mqtt_protocol == mqtt.MQTTv5:
+        properties = Properties(PacketTypes.CONNECT)
+        properties.SessionExpiryInterval = mqtt_broker['session_expiry_in_seconds']
+        client.connect(hostname, port=port, keepalive=keepalive,
+                       clean_start=mqtt.MQTT_CLEAN_START_FIRST_ONLY, properties=properties)
+    else:
+        client.connect(hostname, port=port, keepalive=keepalive)
+
+def startMqttClient():
+    # connect (falling back from v5 to v3.1.1 if need be) and wait until the broker accepts us
+    #  returns False if we could not connect
+    global mqtt_client
+    global mqtt_protocol
+    global mqtt_fallback_to_v311_requested
+    mqtt_protocol = mqtt.MQTTv5 if mqtt_broker['protocol'] == '5' else mqtt.MQTTv311
+    print_line('Connecting to MQTT broker (MQTT v{}) ...'.format(mqtt_broker['protocol']), verbose=True)
+    mqtt_client = createMqttClient()
+    try:
+        connectMqttClient(mqtt_client)
+    except:
+        print_line('MQTT connection error. Please check your settings in the configuration file "config.ini"', error=True, sd_notify=True)
+        return False
     mqtt_client.loop_start()
 
+    waitStartTime = time()
     while mqtt_client_connected == False: #wait in loop
         print_line('* Wait on mqtt_client_connected=[{}]'.format(mqtt_client_connected), debug=True)
+        v5_timed_out = mqtt_protocol == mqtt.MQTTv5 and time() - waitStartTime > MQTT_V5_CONNACK_TIMEOUT_IN_SECONDS
+        if mqtt_fallback_to_v311_requested or v5_timed_out:
+            # broker won't talk v5 with us, start over using v3.1.1
+            print_line('* MQTT v5 not available, reconnecting using MQTT v3.1.1', warning=True)
+            mqtt_client.loop_stop()
+            mqtt_client.disconnect()
+            mqtt_protocol = mqtt.MQTTv311
+            mqtt_fallback_to_v311_requested = False
+            mqtt_client = createMqttClient()
+            try:
+                connectMqttClient(mqtt_client)
+            except:
+                print_line('MQTT connection error. Please check your settings in the configuration file "config.ini"', error=True, sd_notify=True)
+                return False
+            mqtt_client.loop_start()
         sleep(1.0) # some slack to establish the connection
+    return True
+
+def stopMqttClient():
+    mqtt_client.disconnect()
+    mqtt_client.loop_stop()
+
+def setupTopics():
+    # (re)build all of our topics from base_topic and sensor_name
+    global sensor_name
+    global base_topic
+    global lwt_topic
+    global values_topic
+    global activity_topic
+    global alert_topic
+    global history_topic
+    sensor_name = config_sensor_name
+    if sensor_name == default_sensor_name:
+        sensor_name = 'dvc-{}'.format(dvc_hostname.lower())
+    base_topic = '{}/sensor/{}'.format(config_base_topic, sensor_name.lower())
+    lwt_topic = '{}/status'.format(base_topic)
+    values_topic = '{}/{}'.format(base_topic, LD_MONITOR)
+    activity_topic = '{}/status'.format(base_topic)    # vs. LWT
+    alert_topic = '{}/alert'.format(base_topic)
+    history_topic = '{}/history'.format(base_topic)
+    mqtt_topic_aliases.clear()
+    mqtt_topic_aliases[values_topic] = TOPIC_ALIAS_MONITOR
+    mqtt_topic_aliases[lwt_topic] = TOPIC_ALIAS_STATUS
 
-    startAliveTimer()
+# MQTT connection
+lwt_online_val = 'online'
+lwt_offline_val = 'offline'
+
+# our IoT Reporter device
+LD_MONITOR = "monitor" # KeyError: 'home310/sensor/rpi-pi3plus/values' let's not use this 'values' as topic
+LD_FS_USED = "disk_used"
+LDS_PAYLOAD_NAME = "info"
+
+setupTopics()
+if not startMqttClient():
+    sys.exit(1)
+startAliveTimer()
+addCommandHandler(HEARTBEAT_COMMAND, handleHeartbeatRequest)
 
 
 # -----------------------------------------------------------------------------
@@ -644,10 +1433,11 @@ mac_right = mac_basic[6:]
 print_line('mac lt=[{}], rt=[{}], mac=[{}]'.format(mac_left, mac_right, mac_basic), debug=True)
 uniqID = "IoT-{}Mon{}".format(mac_left, mac_right)
 
-# our IoT Reporter device
-LD_MONITOR = "monitor" # KeyError: 'home310/sensor/rpi-pi3plus/values' let's not use this 'values' as topic
-LD_FS_USED = "disk_used"
-LDS_PAYLOAD_NAME = "info"
+def getPhaseOffset(periodInSeconds):
+    # stable per-device offset into a period, the same on every start (unlike hash())
+    if periodInSeconds < 1:
+        return 0
+    return zlib.crc32(uniqID.encode('utf-8')) % int(periodInSeconds)
 
 # Publish our MQTT auto discovery
 #  table of key items to publish:
@@ -656,55 +1446,65 @@ detectorValues = OrderedDict([
     (LD_FS_USED, dict(title="Used {}".format(dvc_hostname), no_title_prefix="yes", json_value="fs_free_prcnt", unit="%", icon='mdi:sd')),
 ])
 
-print_line('Announcing IoT Monitoring device to MQTT broker for auto-discovery ...')
-
-base_topic = '{}/sensor/{}'.format(base_topic, sensor_name.lower())
 values_topic_rel = '{}/{}'.format('~', LD_MONITOR)
-values_topic = '{}/{}'.format(base_topic, LD_MONITOR)
 activity_topic_rel = '{}/status'.format('~')     # vs. LWT
-activity_topic = '{}/status'.format(base_topic)    # vs. LWT
 
 command_topic_rel = '~/set'
 
-for [sensor, params] in detectorValues.items():
-    discovery_topic = 'homeassistant/sensor/{}/{}/config'.format(sensor_name.lower(), sensor)
-    payload = OrderedDict()
-    if 'no_title_prefix' in params:
-        payload['name'] = "{}".format(params['title'].title())
-    else:
-        payload['name'] = "{} {}".format(sensor_name.title(), params['title'].title())
-    payload['uniq_id'] = "{}_{}".format(uniqID, sensor.lower())
-    if 'device_class' in params:
-        payload['dev_cla'] = params['device_class']
-    if 'unit' in params:
-        payload['unit_of_measurement'] = params['unit']
-    if 'json_value' in params:
-        payload['stat_t'] = values_topic_rel
-        payload['val_tpl'] = "{{{{ value_json.{}.{} }}}}".format(LDS_PAYLOAD_NAME, params['json_value'])
-    payload['~'] = base_topic
-    payload['pl_avail'] = lwt_online_val
-    payload['pl_not_avail'] = lwt_offline_val
-    if 'icon' in params:
-        payload['ic'] = params['icon']
-    payload['avty_t'] = activity_topic_rel
-    if 'json_attr' in params:
-        payload['json_attr_t'] = values_topic_rel
-        payload['json_attr_tpl'] = '{{{{ value_json.{} | tojson }}}}'.format(LDS_PAYLOAD_NAME)
-    if 'device_ident' in params:
-        payload['dev'] = {
-                'identifiers' : ["{}".format(uniqID)],
-                'manufacturer' : 'Onion Corporation',
-                'name' : params['device_ident'],
-                'model' : '{}'.format(dvc_model),
-                'sw_version': "v{}".format(dvc_firmware_version)
-        }
-    else:
-         payload['dev'] = {
-                'identifiers' : ["{}".format(uniqID)],
-         }
-    mqtt_client.publish(discovery_topic, json.dumps(payload), 1, retain=True)
-
-    # remove connections as test:                  'connections' : [["mac", mac.lower()], [interface, ipaddr]],
+def publishDiscovery():
+    print_line('Announcing IoT Monitoring device to MQTT broker for auto-discovery ...')
+    for [sensor, params] in detectorValues.items():
+        discovery_topic = 'homeassistant/sensor/{}/{}/config'.format(sensor_name.lower(), sensor)
+        payload = OrderedDict()
+        if 'no_title_prefix' in params:
+            payload['name'] = "{}".format(params['title'].title())
+        else:
+            payload['name'] = "{} {}".format(sensor_name.title(), params['title'].title())
+        payload['uniq_id'] = "{}_{}".format(uniqID, sensor.lower())
+        if 'device_class' in params:
+            payload['dev_cla'] = params['device_class']
+        if 'unit' in params:
+            payload['unit_of_measurement'] = params['unit']
+        if 'json_value' in params:
+            payload['stat_t'] = values_topic_rel
+            payload['val_tpl'] = "{{{{ value_json.{}.{} }}}}".format(LDS_PAYLOAD_NAME, params['json_value'])
+        payload['~'] = base_topic
+        payload['pl_avail'] = lwt_online_val
+        payload['pl_not_avail'] = lwt_offline_val
+        if 'icon' in params:
+            payload['ic'] = params['icon']
+        payload['avty_t'] = activity_topic_rel
+        if 'json_attr' in params:
+            payload['json_attr_t'] = values_topic_rel
+            payload['json_attr_tpl'] = '{{{{ value_json.{} | tojson }}}}'.format(LDS_PAYLOAD_NAME)
+        if 'device_ident' in params:
+            payload['dev'] = {
+                    'identifiers' : ["{}".format(uniqID)],
+                    'manufacturer' : 'Onion Corporation',
+                    'name' : params['device_ident'],
+                    'model' : '{}'.format(dvc_model),
+                    'sw_version': "v{}".format(dvc_firmware_version)
+            }
+        else:
+             payload['dev'] = {
+                    'identifiers' : ["{}".format(uniqID)],
+             }
+        mqtt_client.publish(discovery_topic, json.dumps(payload), 1, retain=True)
+
+        # remove connections as test:                  'connections' : [["mac", mac.lower()], [interface, ipaddr]],
+
+def clearDiscovery(priorSensorName):
+    # remove the retained discovery configs announced under a prior sensor name
+    for sensor in detectorValues:
+        discovery_topic = 'homeassistant/sensor/{}/{}/config'.format(priorSensorName.lower(), sensor)
+        mqtt_client.publish(discovery_topic, '', 1, retain=True)
+
+if report_schedule == 'aligned' and startup_spread_in_seconds > 0:
+    # don't announce in the same second as every other device powered up with us
+    startupDelay = getPhaseOffset(startup_spread_in_seconds)
+    print_line('Spreading startup: announcing in {} seconds'.format(startupDelay), verbose=True)
+    sleep(startupDelay)
+publishDiscovery()
 
 # -----------------------------------------------------------------------------
 #  timer and timer funcs for period handling
@@ -715,17 +1515,33 @@ TEST_INTERRUPT = (-2)
 
 def periodTimeoutHandler():
     print_line('- PERIOD TIMER INTERRUPT -', debug=True)
-    handle_interrupt(TIMER_INTERRUPT) # '0' means we have a timer interrupt!!!
+    # re-arm first so one stuck cycle can't silently end our reporting
     startPeriodTimer()
+    handle_interrupt(TIMER_INTERRUPT) # '0' means we have a timer interrupt!!!
 
 def startPeriodTimer():
     global endPeriodTimer
     global periodTimeRunningStatus
     stopPeriodTimer()
-    endPeriodTimer = threading.Timer(interval_in_minutes * 60.0, periodTimeoutHandler)
+    endPeriodTimer = threading.Timer(getPeriodDelay(), periodTimeoutHandler)
     endPeriodTimer.start()
     periodTimeRunningStatus = True
-    print_line('- started PERIOD timer - every {} seconds'.format(interval_in_minutes * 60.0), debug=True)
+    print_line('- started PERIOD timer - every {} seconds ({})'.format(interval_in_minutes * 60.0 * interval_stretch, report_schedule), debug=True)
+
+def getPeriodDelay():
+    # seconds until our next report
+    periodInSeconds = interval_in_minutes * 60.0 * interval_stretch
+    if report_schedule != 'aligned':
+        return periodInSeconds
+    # next wall-clock interval boundary plus our offset, e.g. 12:05:17, 12:10:17, ...
+    phaseOffset = getPhaseOffset(periodInSeconds)
+    timeNow = time()
+    nextReport = ((timeNow - phaseOffset) // periodInSeconds + 1) * periodInSeconds + phaseOffset
+    delayInSeconds = nextReport - timeNow
+    if delayInSeconds < 1.0:
+        # our timer fired a hair early, don't report twice for the same boundary
+        delayInSeconds += periodInSeconds
+    return delayInSeconds
 
 def stopPeriodTimer():
     global endPeriodTimer
@@ -784,6 +1600,39 @@ DVC_CPU_HARDWARE = "hardware"
 DVC_CPU_MODEL = "model_name"
 DVC_CPU_CORES = "number_cores"
 DVC_CPU_BOGOMIPS = "bogo_mips"
+# values from timed-out collectors, and our own health
+DVC_STALE = "stale"
+DVC_REPORTER_STATS = "reporter_stats"
+RPT_STUCK_CYCLES = "stuck_cycles"
+RPT_SKIPPED_CYCLES = "skipped_cycles"
+RPT_COLLECTOR_TIMEOUTS = "collector_timeouts"
+RPT_HEARTBEATS = "heartbeats"
+RPT_HEARTBEAT_RATE = "heartbeats_per_hour"
+RPT_TLS = "tls"
+RPT_TLS_HANDSHAKE_MS = "last_handshake_ms"
+RPT_TLS_HANDSHAKES = "handshakes"
+RPT_TLS_RESUMED = "resumed_handshakes"
+RPT_THROTTLE = "throttle"
+RPT_THROTTLE_LOAD = "load_per_core"
+RPT_THROTTLE_CPU = "cycle_cpu_sec"
+RPT_THROTTLE_STRETCH = "interval_stretch"
+RPT_THROTTLE_SKIPPED = "skipped_collectors"
+# threshold alerts
+LDS_ALERT_PAYLOAD_NAME = "alert"
+ALERT_NAME = "name"
+ALERT_METRIC = "metric"
+ALERT_STATE = "state"
+ALERT_VALUE = "value"
+ALERT_THRESHOLD = "threshold"
+# history backfill
+LDS_HISTORY_PAYLOAD_NAME = "history"
+HIST_REQUEST_ID = "id"
+HIST_FROM = "from"
+HIST_TO = "to"
+HIST_CHUNK = "chunk"
+HIST_CHUNKS = "chunks"
+HIST_FIELDS = "fields"
+HIST_RECORDS = "records"
 
 
 def send_status(timestamp, nothing):
@@ -826,10 +1675,14 @@ def send_status(timestamp, nothing):
     dvcData[DVC_SCRIPT] = dvc_mqtt_script.replace('.py', '')
     dvcData[SCRIPT_REPORT_INTERVAL] = interval_in_minutes
 
+    if len(dvc_stale_collectors) > 0:
+        dvcData[DVC_STALE] = sorted(dvc_stale_collectors)
+    dvcData[DVC_REPORTER_STATS] = getReporterStatsDictionary()
+
     dvcTopDict = OrderedDict()
     dvcTopDict[LDS_PAYLOAD_NAME] = dvcData
 
-    _thread.start_new_thread(publishMonitorData, (dvcTopDict, values_topic))
+    publishToSinks(dvcTopDict)
 
 def getDrivesDictionary():
     dvcDrives = OrderedDict()
@@ -912,17 +1765,225 @@ def getCPUDictionary():
 
 def publishMonitorData(latestData, topic):
     print_line('Publishing to MQTT topic "{}, Data:{}"'.format(topic, json.dumps(latestData)))
-    mqtt_client.publish('{}'.format(topic), json.dumps(latestData), 1, retain=False)
+    # on v5 we publish at QoS 0 so the report can go out alias-only (see publishToTopic()),
+    #  the broker drops it after message_expiry_in_seconds anyway
+    qos = 0 if mqtt_protocol == mqtt.MQTTv5 else 1
+    publishToTopic('{}'.format(topic), json.dumps(latestData), qos, retain=False, expiry_in_seconds=message_expiry_in_seconds)
     sleep(0.5) # some slack for the publish roundtrip and callback function
 
 
+# -----------------------------------------------------------------------------
+#  output sinks: each report is collected once and handed to every sink
+# -----------------------------------------------------------------------------
+
+PROMETHEUS_PREFIX = 'omega2_'
+
+# sink name -> function(report)
+output_sinks = OrderedDict()
+
+def addOutputSink(sinkName, sink):
+    output_sinks[sinkName] = sink
+    print_line('- output sink [{}] added'.format(sinkName), debug=True)
+
+def publishToSinks(latestData):
+    for [sinkName, sink] in output_sinks.items():
+        try:
+            sink(latestData)
+        except Exception as sinkErr:
+            # one failing sink must not keep the report from the others
+            print_line('Output sink [{}] failed: {}'.format(sinkName, sinkErr), error=True)
+
+def mqttSink(latestData):
+    _thread.start_new_thread(publishMonitorData, (latestData, values_topic))
+
+def prometheusLabels(labels):
+    if len(labels) == 0:
+        return ''
+    labelParts = []
+    for [labelName, labelValue] in labels.items():
+        escapedValue = str(labelValue).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        labelParts.append('{}="{}"'.format(labelName, escapedValue))
+    return '{{{}}}'.format(','.join(labelParts))
+
+def addPrometheusMetric(lines, metricName, metricType, helpText, samples):
+    # samples: list of (labels dict, value)
+    if len(samples) == 0:
+        return
+    fullName = '{}{}'.format(PROMETHEUS_PREFIX, metricName)
+    lines.append('# HELP {} {}'.format(fullName, helpText))
+    lines.append('# TYPE {} {}'.format(fullName, metricType))
+    for [labels, value] in samples:
+        lines.append('{}{} {}'.format(fullName, prometheusLabels(labels), value))
+
+def renderPrometheus(latestData):
+    # our report in Prometheus text exposition format
+    dvcData = latestData[LDS_PAYLOAD_NAME]
+    lines = []
+    infoLabels = OrderedDict()
+    for [labelName, dataKey] in [['host_name', DVC_HOSTNAME], ['fqdn', DVC_FQDN], ['model', DVC_MODEL], ['ux_release', DVC_LINUX_RELEASE], ['ux_version', DVC_LINUX_VERSION], ['reporter', DVC_SCRIPT]]:
+        infoLabels[labelName] = dvcData.get(dataKey, '')
+    addPrometheusMetric(lines, 'info', 'gauge', 'Device and reporter identity', [(infoLabels, 1)])
+    addPrometheusMetric(lines, 'report_timestamp_seconds', 'gauge', 'Time of this report', [({}, int(datetime.fromisoformat(dvcData[SCRIPT_TIMESTAMP]).timestamp()))])
+    if dvcData.get(DVC_DATE_LAST_UPDATE, '') != '':
+        addPrometheusMetric(lines, 'last_update_timestamp_seconds', 'gauge', 'Time updates were last applied', [({}, int(datetime.fromisoformat(dvcData[DVC_DATE_LAST_UPDATE]).timestamp()))])
+    addPrometheusMetric(lines, 'report_interval_minutes', 'gauge', 'Configured report interval', [({}, dvcData[SCRIPT_REPORT_INTERVAL])])
+    addPrometheusMetric(lines, 'fs_total_gb', 'gauge', 'Size of the root filesystem', [({}, dvcData[DVC_FS_SPACE])])
+    addPrometheusMetric(lines, 'fs_used_percent', 'gauge', 'Percent used of the root filesystem', [({}, dvcData[DVC_FS_AVAIL])])
+    driveSizes = []
+    driveUsed = []
+    for dvcDrive in dvcData.get(DVC_DRIVES, {}).values():
+        driveLabels = OrderedDict([('mount', dvcDrive[DVC_DRV_MOUNT])])
+        driveSizes.append((driveLabels, dvcDrive[DVC_DRV_BLOCKS]))
+        driveUsed.append((driveLabels, dvcDrive[DVC_DRV_USED]))
+    addPrometheusMetric(lines, 'drive_size_gb', 'gauge', 'Size of mounted filesystem', driveSizes)
+    addPrometheusMetric(lines, 'drive_used_percent', 'gauge', 'Percent used of mounted filesystem', driveUsed)
+    dvcRam = dvcData.get(DVC_MEMORY, {})
+    if len(dvcRam) > 0:
+        addPrometheusMetric(lines, 'memory_size_mb', 'gauge', 'Total memory', [({}, dvcRam[DVC_MEM_TOTAL])])
+        addPrometheusMetric(lines, 'memory_free_mb', 'gauge', 'Memory available', [({}, dvcRam[DVC_MEM_FREE])])
+    dvcCpu = dvcData.get(DVC_CPU, {})
+    if len(dvcCpu) > 0:
+        addPrometheusMetric(lines, 'cpu_bogo_mips', 'gauge', 'CPU BogoMIPS', [({}, dvcCpu[DVC_CPU_BOGOMIPS])])
+    networkInfo = []
+    for [interface, ifData] in dvcData.get(DVC_NETWORK, {}).items():
+        ifLabels = OrderedDict([('interface', interface)])
+        for [subKey, subValue] in ifData.items():
+            ifLabels[subKey.lower()] = subValue
+        networkInfo.append((ifLabels, 1))
+    addPrometheusMetric(lines, 'network_info', 'gauge', 'Network interfaces, with IP when connected', networkInfo)
+    addPrometheusMetric(lines, 'stale', 'gauge', 'Collectors whose values are from an earlier report', [(OrderedDict([('collector', collectorName)]), 1) for collectorName in dvcData.get(DVC_STALE, [])])
+    reporterStats = dvcData.get(DVC_REPORTER_STATS, {})
+    for [statKey, helpText] in [[RPT_STUCK_CYCLES, 'Report cycles found stuck'], [RPT_SKIPPED_CYCLES, 'Report cycles skipped, prior cycle still running'], [RPT_HEARTBEATS, 'Heartbeats (online) published']]:
+        if statKey in reporterStats:
+            addPrometheusMetric(lines, 'reporter_{}_total'.format(statKey), 'counter', helpText, [({}, reporterStats[statKey])])
+    collectorTimeouts = reporterStats.get(RPT_COLLECTOR_TIMEOUTS, {})
+    addPrometheusMetric(lines, 'reporter_collector_timeouts_total', 'counter', 'Collector runs past their deadline', [(OrderedDict([('collector', collectorName)]), count) for [collectorName, count] in collectorTimeouts.items()])
+    tlsInfo = reporterStats.get(RPT_TLS, {})
+    if RPT_TLS_HANDSHAKES in tlsInfo:
+        addPrometheusMetric(lines, 'tls_last_handshake_seconds', 'gauge', 'Duration of our last TLS handshake with the broker', [({}, tlsInfo[RPT_TLS_HANDSHAKE_MS] / 1000)])
+        addPrometheusMetric(lines, 'tls_handshakes_total', 'counter', 'TLS handshakes with the broker', [({}, tlsInfo[RPT_TLS_HANDSHAKES])])
+        addPrometheusMetric(lines, 'tls_resumed_handshakes_total', 'counter', 'TLS handshakes resuming our prior session', [({}, tlsInfo[RPT_TLS_RESUMED])])
+    throttleInfo = reporterStats.get(RPT_THROTTLE, {})
+    if RPT_THROTTLE_STRETCH in throttleInfo:
+        addPrometheusMetric(lines, 'reporter_interval_stretch', 'gauge', 'Report interval multiplier while throttled (1 = normal)', [({}, throttleInfo[RPT_THROTTLE_STRETCH])])
+        addPrometheusMetric(lines, 'reporter_cycle_cpu_seconds', 'gauge', 'Our CPU time during the last report cycle', [({}, throttleInfo[RPT_THROTTLE_CPU])])
+    return '\n'.join(lines) + '\n'
+
+def fileSink(latestData):
+    if sink_file_format == 'json':
+        fileText = json.dumps(latestData)
+    else:
+        fileText = renderPrometheus(latestData)
+    # write aside then rename so readers never see a partial file
+    tmpFilespec = '{}.tmp'.format(sink_filespec)
+    with open(tmpFilespec, 'w') as sinkFile:
+        sinkFile.write(fileText)
+    os.replace(tmpFilespec, sink_filespec)
+
+# latest report as served by our scrape endpoint
+prometheus_text = ''
+
+def httpSink(latestData):
+    global prometheus_text
+    prometheus_text = renderPrometheus(latestData)
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        scrapeText = prometheus_text
+        if scrapeText == '':
+            self.send_error(503, 'No report yet')
+            return
+        body = scrapeText.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        print_line('http: {}'.format(format % args), debug=True)
+
+def startOutputSinks():
+    addOutputSink('mqtt', mqttSink)
+    if sink_http_port > 0:
+        try:
+            httpServer = HTTPServer((sink_http_bind_address, sink_http_port), MetricsRequestHandler)
+        except OSError as bindErr:
+            print_line('Scrape endpoint on port {} not available ({}), NOT serving metrics'.format(sink_http_port, bindErr), error=True)
+        else:
+            httpThread = threading.Thread(target=httpServer.serve_forever, name='http-sink', daemon=True)
+            httpThread.start()
+            addOutputSink('http', httpSink)
+            print_line('Serving metrics on http://{}:{}/metrics'.format(sink_http_bind_address, sink_http_port), verbose=True)
+    if sink_filespec != '':
+        addOutputSink('file', fileSink)
+
+# collectors rerun every report cycle -> the collectors each must run after
+#  (none of these depend on one another today, they each fill their own dvc_* values)
+PERIODIC_COLLECTORS = OrderedDict([
+    (getUptime, []),
+    (getDeviceMemory, []),
+    (getFileSystemDrives, []),
+    (getSystemTemperature, []),
+    (getLastUpdateDate, []),
+])
+if ubus_socket_spec != '':
+    # one ubus call replaces the uptime and memory probes
+    del PERIODIC_COLLECTORS[getUptime]
+    del PERIODIC_COLLECTORS[getDeviceMemory]
+    PERIODIC_COLLECTORS[getUbusSystemInfo] = []
+
+# collectors we skip while throttled (their last values are reported), the rest are cheap
+#  ('df' walks every mount)
+THROTTLE_SKIPPABLE_COLLECTORS = [getFileSystemDrives]
+
+# throttle state, see throttleCycle()
+throttle_skipping = False
+throttle_load_per_core = 0.0
+throttle_cycle_cpu = 0.0
+
+def getCpuSeconds():
+    # our CPU time so far, including the commands we ran
+    cpuTimes = os.times()
+    return cpuTimes.user + cpuTimes.system + cpuTimes.children_user + cpuTimes.children_system
+
+def throttleCycle(cycleCpuSeconds):
+    # back off while the host is busy, return to normal once it is idle again
+    global interval_stretch
+    global throttle_skipping
+    global throttle_load_per_core
+    global throttle_cycle_cpu
+    throttle_cycle_cpu = cycleCpuSeconds
+    throttle_load_per_core = os.getloadavg()[0] / (os.cpu_count() or 1)
+    priorStretch = interval_stretch
+    if throttle_load_per_core > throttle_load:
+        interval_stretch = min(interval_stretch + 1, max_interval_stretch)
+        # once skipping, keep at it while busy (else we'd flip as our cost drops)
+        throttle_skipping = throttle_skipping or cycleCpuSeconds > throttle_cpu_in_seconds
+    elif throttle_load_per_core < throttle_load / 2:
+        interval_stretch = max(interval_stretch - 1, 1)
+        throttle_skipping = False
+    if interval_stretch != priorStretch:
+        print_line('Load {:.2f}/core, our cycle {:.3f} CPU sec: reporting every {} min{}'.format(throttle_load_per_core, cycleCpuSeconds, interval_in_minutes * interval_stretch, ', skipping expensive collectors' if throttle_skipping else ''), verbose=True)
+        # takes effect as our period timer is re-armed
+
 def update_values():
-    # nothing here yet
-    getUptime()
-    getDeviceMemory()
-    getFileSystemDrives()
-    getSystemTemperature()
-    getLastUpdateDate()
+    collectors = OrderedDict(PERIODIC_COLLECTORS)
+    if isUpdateDateWatched():
+        del collectors[getLastUpdateDate]
+    if throttle_skipping:
+        for collector in THROTTLE_SKIPPABLE_COLLECTORS:
+            collectors.pop(collector, None)
+    cycleStartTime = time()
+    cycleStartCpu = getCpuSeconds()
+    collectorsTime = runCollectors(collectors)
+    cycleCpu = getCpuSeconds() - cycleStartCpu
+    print_line('update_values() took {:.3f} sec (collectors sum {:.3f} sec, {} workers, {:.3f} CPU sec)'.format(time() - cycleStartTime, collectorsTime, collector_workers, cycleCpu), debug=True)
+    if low_impact_enabled:
+        throttleCycle(cycleCpu)
 
 
 
@@ -931,19 +1992,706 @@ def update_values():
 # Interrupt handler
 def handle_interrupt(channel):
     global reported_first_time
+    global skipped_cycle_count
     sourceID = "<< INTR(" + str(channel) + ")"
     current_timestamp = datetime.now(local_tz)
-    print_line(sourceID + " >> Time to report! (%s)" % current_timestamp.strftime('%H:%M:%S - %Y/%m/%d'), verbose=True)
-    # ----------------------------------
-    # have PERIOD interrupt!
-    update_values()
-
-    if (opt_stall == False or reported_first_time == False and opt_stall == True):
-        # ok, report our new detection to MQTT
-        _thread.start_new_thread(send_status, (current_timestamp, ''))
-        reported_first_time = True
-    else:
-        print_line(sourceID + " >> Time to report! (%s) but SKIPPED (TEST: stall)" % current_timestamp.strftime('%H:%M:%S - %Y/%m/%d'), verbose=True)
+    if not startCycle():
+        skipped_cycle_count += 1
+        print_line(sourceID + " >> Time to report! (%s) but SKIPPED (prior cycle still running)" % current_timestamp.strftime('%H:%M:%S - %Y/%m/%d'), warning=True)
+        return
+    try:
+        print_line(sourceID + " >> Time to report! (%s)" % current_timestamp.strftime('%H:%M:%S - %Y/%m/%d'), verbose=True)
+        # ----------------------------------
+        # have PERIOD interrupt!
+        update_values()
+        if channel in (TIMER_INTERRUPT, 0):
+            # only the period timer (and our first report), keep samples evenly spaced
+            appendHistoryRecord(current_timestamp)
+
+        if (opt_stall == False or reported_first_time == False and opt_stall == True):
+            # ok, report our new detection to MQTT
+            _thread.start_new_thread(send_status, (current_timestamp, ''))
+            reported_first_time = True
+        else:
+            print_line(sourceID + " >> Time to report! (%s) but SKIPPED (TEST: stall)" % current_timestamp.strftime('%H:%M:%S - %Y/%m/%d'), verbose=True)
+    finally:
+        endCycle()
+
+# -----------------------------------------------------------------------------
+#  report cycle tracking and watchdog
+# -----------------------------------------------------------------------------
+
+WATCHDOG_CHECK_INTERVAL_IN_SECONDS = 10
+
+cycle_lock = threading.Lock()
+cycle_start_time = 0        # 0 = no cycle in progress
+cycle_reported_stuck = False
+stuck_cycle_count = 0
+skipped_cycle_count = 0
+
+def startCycle():
+    # returns False if a prior cycle is still running
+    global cycle_start_time
+    global cycle_reported_stuck
+    if not cycle_lock.acquire(blocking=False):
+        return False
+    cycle_start_time = time()
+    cycle_reported_stuck = False
+    return True
+
+def endCycle():
+    global cycle_start_time
+    if cycle_reported_stuck:
+        print_line('* report cycle recovered after {:.1f} seconds'.format(time() - cycle_start_time), warning=True)
+    cycle_start_time = 0
+    cycle_lock.release()
+
+def watchdogTimeoutHandler():
+    global cycle_reported_stuck
+    global stuck_cycle_count
+    cycleStart = cycle_start_time
+    if cycleStart > 0 and not cycle_reported_stuck and time() - cycleStart > watchdog_timeout_in_seconds:
+        cycle_reported_stuck = True
+        stuck_cycle_count += 1
+        print_line('* report cycle STUCK for {:.1f} seconds (stale: {})'.format(time() - cycleStart, ', '.join(sorted(dvc_stale_collectors))), error=True, sd_notify=True)
+    startWatchdogTimer()
+
+def startWatchdogTimer():
+    global watchdogTimer
+    stopWatchdogTimer()
+    watchdogTimer = threading.Timer(WATCHDOG_CHECK_INTERVAL_IN_SECONDS, watchdogTimeoutHandler)
+    watchdogTimer.daemon = True
+    watchdogTimer.start()
+
+def stopWatchdogTimer():
+    global watchdogTimer
+    if watchdogTimer is not None:
+        watchdogTimer.cancel()
+
+# our WATCHDOG TIMER
+watchdogTimer = None
+
+def getReporterStatsDictionary():
+    statsDict = OrderedDict()
+    statsDict[RPT_STUCK_CYCLES] = stuck_cycle_count
+    statsDict[RPT_SKIPPED_CYCLES] = skipped_cycle_count
+    statsDict[RPT_HEARTBEATS] = heartbeat_count
+    statsDict[RPT_HEARTBEAT_RATE] = getHeartbeatsPerHour()
+    if len(collector_timeout_counts) > 0:
+        statsDict[RPT_COLLECTOR_TIMEOUTS] = OrderedDict(collector_timeout_counts)
+    if mqtt_broker['tls']:
+        statsDict[RPT_TLS] = getTlsStatsDictionary()
+    if low_impact_enabled:
+        throttleDict = OrderedDict()
+        throttleDict[RPT_THROTTLE_LOAD] = round(throttle_load_per_core, 2)
+        throttleDict[RPT_THROTTLE_CPU] = round(throttle_cycle_cpu, 3)
+        throttleDict[RPT_THROTTLE_STRETCH] = interval_stretch
+        throttleDict[RPT_THROTTLE_SKIPPED] = [collector.__name__ for collector in THROTTLE_SKIPPABLE_COLLECTORS] if throttle_skipping else []
+        statsDict[RPT_THROTTLE] = throttleDict
+    return statsDict
+
+# -----------------------------------------------------------------------------
+#  event triggers: inotify on update-date files, rtnetlink for interfaces
+# -----------------------------------------------------------------------------
+
+EVENT_SRC_UPDATE_DATES = 'update-dates'
+EVENT_SRC_NETWORK = 'network'
+
+# inotify(7) event masks
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+INOTIFY_EVENT_HDR = struct.Struct('iIII')   # wd, mask, cookie, len
+
+# rtnetlink(7) multicast groups and message types
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+NLMSG_HDR = struct.Struct('IHHII')          # len, type, flags, seq, pid
+IFINFOMSG = struct.Struct('BxHiII')         # family, type, index, flags, change
+RTATTR_HDR = struct.Struct('HH')            # len, type
+IFLA_WIRELESS = 11
+IFLA_OPERSTATE = 16
+
+libc = None
+inotify_fd = -1
+inotify_watched_dirs = {}   # watch descriptor -> directory
+netlink_socket = None
+netlink_link_states = {}    # interface index -> (flags, operstate) as last seen
+pending_event_sources = set()
+event_lock = threading.Lock()
+eventDebounceTimer = None
+
+def isUpdateDateWatched():
+    return inotify_fd >= 0
+
+def addInotifyWatch(dirspec):
+    wd = libc.inotify_add_watch(inotify_fd, dirspec.encode('utf-8'), IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+    if wd < 0:
+        print_line('inotify_add_watch({}) failed errno=[{}]'.format(dirspec, ctypes.get_errno()), debug=True)
+        return False
+    inotify_watched_dirs[wd] = dirspec
+    print_line('- watching [{}] wd=[{}]'.format(dirspec, wd), debug=True)
+    return True
+
+def startInotifyWatch():
+    global inotify_fd
+    global libc
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init()
+    except (OSError, AttributeError):
+        fd = -1
+    if fd < 0:
+        print_line('inotify not available, update dates will be polled', warning=True)
+        return
+    inotify_fd = fd
+    # we watch the directories, our files come and go (and may not exist yet)
+    for filespec in (opkg_log_filespec, oupgrade_log_filespec):
+        dirspec = os.path.dirname(filespec)
+        if dirspec in inotify_watched_dirs.values():
+            continue
+        if not os.path.isdir(dirspec) or not addInotifyWatch(dirspec):
+            # opkg-lists/ is created by the first 'opkg update', watch for it in its parent
+            parentspec = os.path.dirname(dirspec)
+            if parentspec not in inotify_watched_dirs.values():
+                addInotifyWatch(parentspec)
+
+def readInotifyEvents():
+    # return True if any event touched one of our update-date files
+    interesting = False
+    watchedFiles = (opkg_log_filespec, oupgrade_log_filespec)
+    buffer = os.read(inotify_fd, 4096)
+    offset = 0
+    while offset + INOTIFY_EVENT_HDR.size <= len(buffer):
+        wd, mask, cookie, nameLen = INOTIFY_EVENT_HDR.unpack_from(buffer, offset)
+        offset += INOTIFY_EVENT_HDR.size
+        name = buffer[offset:offset + nameLen].rstrip(b'\0').decode('utf-8', 'replace')
+        offset += nameLen
+        if mask & IN_Q_OVERFLOW:
+            # the kernel dropped events, we can't tell which of our files changed
+            interesting = True
+            continue
+        dirspec = inotify_watched_dirs.get(wd, '')
+        filespec = os.path.join(dirspec, name)
+        if filespec in watchedFiles:
+            interesting = True
+        elif (mask & IN_ISDIR) and filespec in [os.path.dirname(spec) for spec in watchedFiles]:
+            # our watched directory just appeared
+            if filespec not in inotify_watched_dirs.values() and addInotifyWatch(filespec):
+                interesting = True
+    return interesting
+
+def startNetlinkWatch():
+    global netlink_socket
+    try:
+        nlSocket = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        nlSocket.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR))
+    except (OSError, AttributeError):
+        print_line('rtnetlink not available, network interfaces only read at report time', warning=True)
+        return
+    netlink_socket = nlSocket
+
+def isLinkChange(buffer, offset, msgLen):
+    # RTM_NEWLINK also carries wireless-extensions events (scan, association, roaming on
+    #  apcli0/ra0) and attribute updates, only a change of the link's flags or operstate counts
+    infoOffset = offset + NLMSG_HDR.size
+    if msgLen < NLMSG_HDR.size + IFINFOMSG.size:
+        return True
+    _, _, ifIndex, ifFlags, _ = IFINFOMSG.unpack_from(buffer, infoOffset)
+    operState = None
+    attrOffset = infoOffset + IFINFOMSG.size
+    while attrOffset + RTATTR_HDR.size <= offset + msgLen:
+        attrLen, attrType = RTATTR_HDR.unpack_from(buffer, attrOffset)
+        if attrLen < RTATTR_HDR.size:
+            break
+        if attrType == IFLA_WIRELESS:
+            return False
+        if attrType == IFLA_OPERSTATE and attrLen > RTATTR_HDR.size:
+            operState = buffer[attrOffset + RTATTR_HDR.size]
+        attrOffset += (attrLen + 3) & ~3    # RTA_ALIGN
+    linkState = (ifFlags, operState)
+    if netlink_link_states.get(ifIndex) == linkState:
+        return False
+    netlink_link_states[ifIndex] = linkState
+    return True
+
+def readNetlinkEvents():
+    # return True if any link or address was added/changed/removed
+    interesting = False
+    buffer = netlink_socket.recv(65536)
+    offset = 0
+    while offset + NLMSG_HDR.size <= len(buffer):
+        msgLen, msgType, _, _, _ = NLMSG_HDR.unpack_from(buffer, offset)
+        if msgLen < NLMSG_HDR.size:
+            break
+        if msgType == RTM_NEWLINK:
+            if isLinkChange(buffer, offset, msgLen):
+                interesting = True
+        elif msgType == RTM_DELLINK:
+            if msgLen >= NLMSG_HDR.size + IFINFOMSG.size:
+                netlink_link_states.pop(IFINFOMSG.unpack_from(buffer, offset + NLMSG_HDR.size)[2], None)
+            interesting = True
+        elif msgType in (RTM_NEWADDR, RTM_DELADDR):
+            interesting = True
+        offset += (msgLen + 3) & ~3     # NLMSG_ALIGN
+    return interesting
+
+def eventWatchLoop():
+    global inotify_fd
+    global netlink_socket
+    watchedFds = []
+    if inotify_fd >= 0:
+        watchedFds.append(inotify_fd)
+    if netlink_socket is not None:
+        watchedFds.append(netlink_socket.fileno())
+    try:
+        while True:
+            try:
+                readable, _, _ = select.select(watchedFds, [], [])
+                for fd in readable:
+                    if fd == inotify_fd:
+                        if readInotifyEvents():
+                            queueEvent(EVENT_SRC_UPDATE_DATES)
+                    elif readNetlinkEvents():
+                        queueEvent(EVENT_SRC_NETWORK)
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+                # rtnetlink dropped messages while we were busy, refresh everything we watch
+                print_line('- EVENT rtnetlink overrun, refreshing all', debug=True)
+                netlink_link_states.clear()
+                queueEvent(EVENT_SRC_NETWORK)
+                if inotify_fd >= 0:
+                    queueEvent(EVENT_SRC_UPDATE_DATES)
+    except OSError as e:
+        print_line('EVENT watch failed ({}), changes are only picked up at report time'.format(e), warning=True)
+    finally:
+        # without this thread nobody reads our fds, so fall back to polling
+        if inotify_fd >= 0:
+            fd = inotify_fd
+            inotify_fd = -1
+            os.close(fd)
+        if netlink_socket is not None:
+            netlink_socket.close()
+            netlink_socket = None
+
+def queueEvent(source):
+    # collect events for a short while so a burst (e.g. DHCP renew) causes a single report
+    global eventDebounceTimer
+    with event_lock:
+        pending_event_sources.add(source)
+        if eventDebounceTimer is None:
+            print_line('- EVENT [{}] report in {} seconds'.format(source, event_debounce_in_seconds), debug=True)
+            eventDebounceTimer = threading.Timer(event_debounce_in_seconds, eventDebounceHandler)
+            eventDebounceTimer.start()
+
+def eventDebounceHandler():
+    global eventDebounceTimer
+    with event_lock:
+        sources = set(pending_event_sources)
+        pending_event_sources.clear()
+        eventDebounceTimer = None
+    handle_event(sources)
+
+def startEventTriggers():
+    if not event_triggers_enabled:
+        return
+    startInotifyWatch()
+    startNetlinkWatch()
+    if inotify_fd >= 0 or netlink_socket is not None:
+        watchThread = threading.Thread(target=eventWatchLoop, name='event-watch', daemon=True)
+        watchThread.start()
+        print_line('- started EVENT watch (inotify={}, rtnetlink={})'.format(inotify_fd >= 0, netlink_socket is not None), debug=True)
+
+def stopEventTriggers():
+    if eventDebounceTimer is not None:
+        eventDebounceTimer.cancel()
+
+# -----------------------------------------------------------------------------
+#  threshold alerts: cheap samples between reports, publish on crossing
+# -----------------------------------------------------------------------------
+
+ALERT_INTERRUPT = (-4)
+
+ALERT_STATE_RAISED = 'raised'
+ALERT_STATE_CLEARED = 'cleared'
+
+# alert key -> True while raised
+alert_raised = {}
+
+def isNetworkMount(device):
+    # NFS 'server:/path' (but not the omega2+ 'overlayfs:/overlay') or CIFS '//server/share'
+    return (':' in device and 'overlayfs' not in device) or device.startswith('//')
+
+def getAlertSamples(thresholds):
+    # sample our alert metrics w/o forking: statvfs(), /proc/meminfo, loadavg
+    #  returns list of (alert key, metric, mount, value)
+    samples = []
+    mountThresholds = [key for key in thresholds if thresholds[key][0] == ALERT_FS_USED]
+    if len(mountThresholds) > 0:
+        # tuple { total blocks, used%, mountPoint, device }
+        for driveTuple in dvc_filesystem:
+            mountPoint = driveTuple[2]
+            if isNetworkMount(driveTuple[3]):
+                # statvfs() on a dead server blocks w/o deadline, leave these to the report's 'df'
+                continue
+            key = '{}@{}'.format(ALERT_FS_USED, mountPoint)
+            if key not in thresholds:
+                key = ALERT_FS_USED
+                if key not in thresholds:
+                    continue
+            try:
+                fsStats = os.statvfs(mountPoint)
+            except OSError:
+                continue
+            usedBlocks = fsStats.f_blocks - fsStats.f_bfree
+            usableBlocks = usedBlocks + fsStats.f_bavail
+            if usableBlocks == 0:
+                continue
+            # same rounding (up) as df's Use%
+            usedPercent = -(-usedBlocks * 100 // usableBlocks)
+            samples.append(('{}@{}'.format(ALERT_FS_USED, mountPoint), key, mountPoint, usedPercent))
+    if ALERT_MEM_AVAIL in thresholds:
+        try:
+            with open('/proc/meminfo') as meminfo:
+                for currLine in meminfo:
+                    if currLine.startswith('MemAvailable'):
+                        samples.append((ALERT_MEM_AVAIL, ALERT_MEM_AVAIL, '', float(currLine.split()[1]) / 1024))
+                        break
+        except OSError:
+            pass
+    if ALERT_LOAD in thresholds:
+        samples.append((ALERT_LOAD, ALERT_LOAD, '', os.getloadavg()[0]))
+    return samples
+
+def checkAlertThresholds():
+    # return list of alerts whose state changed: (state key, metric, mount, value, threshold, new state)
+    crossings = []
+    thresholds = alert_thresholds     # a reload may swap in new thresholds while we sample
+    for [stateKey, thresholdKey, mountPoint, value] in getAlertSamples(thresholds):
+        metric, _, setValue, clearValue = thresholds[thresholdKey]
+        isRaised = alert_raised.get(stateKey, False)
+        if metric in ALERT_LOW_METRICS:
+            shouldRaise = value <= setValue
+            shouldClear = value > clearValue
+        else:
+            shouldRaise = value >= setValue
+            shouldClear = value < clearValue
+        if not isRaised and shouldRaise:
+            alert_raised[stateKey] = True
+            crossings.append((stateKey, metric, mountPoint, value, setValue, ALERT_STATE_RAISED))
+        elif isRaised and shouldClear:
+            alert_raised[stateKey] = False
+            crossings.append((stateKey, metric, mountPoint, value, clearValue, ALERT_STATE_CLEARED))
+    return crossings
+
+def publishAlert(timestamp, crossing):
+    stateKey, metric, mountPoint, value, threshold, state = crossing
+    alertData = OrderedDict()
+    alertData[SCRIPT_TIMESTAMP] = timestamp.astimezone().replace(microsecond=0).isoformat()
+    alertData[ALERT_NAME] = stateKey
+    alertData[ALERT_METRIC] = metric
+    if mountPoint != '':
+        alertData[DVC_DRV_MOUNT] = mountPoint
+    alertData[ALERT_STATE] = state
+    alertData[ALERT_VALUE] = round(value, 2)
+    alertData[ALERT_THRESHOLD] = threshold
+    alertTopDict = OrderedDict()
+    alertTopDict[LDS_ALERT_PAYLOAD_NAME] = alertData
+    print_line('Publishing ALERT to MQTT topic "{}, Data:{}"'.format(alert_topic, json.dumps(alertTopDict)), warning=True)
+    publishToTopic(alert_topic, json.dumps(alertTopDict), 1, retain=False)
+
+def alertSampleTimeoutHandler():
+    try:
+        crossings = checkAlertThresholds()
+        if len(crossings) > 0:
+            current_timestamp = datetime.now(local_tz)
+            for crossing in crossings:
+                publishAlert(current_timestamp, crossing)
+            # and a full report right now, not at the next period
+            handle_interrupt(ALERT_INTERRUPT)
+    finally:
+        # whatever went wrong this time, keep sampling
+        startAlertSampleTimer()
+
+def startAlertSampleTimer():
+    global alertSampleTimer
+    if len(alert_thresholds) == 0:
+        return
+    stopAlertSampleTimer()
+    alertSampleTimer = threading.Timer(alert_sample_interval_in_seconds, alertSampleTimeoutHandler)
+    alertSampleTimer.start()
+
+def stopAlertSampleTimer():
+    global alertSampleTimer
+    if alertSampleTimer is not None:
+        alertSampleTimer.cancel()
+
+# our ALERT SAMPLE TIMER
+alertSampleTimer = None
+
+# -----------------------------------------------------------------------------
+#  local time-series history: fixed-size ring of fixed-width records
+# -----------------------------------------------------------------------------
+
+# sequence, timestamp, mem avail (kB), load 1/5/15 min (x100), root fs used %, flags
+HISTORY_RECORD = struct.Struct('<IIIHHHBB')
+HISTORY_FIELDS = ['timestamp', 'mem_avail_kb', 'load_1min', 'load_5min', 'load_15min', 'fs_used_prcnt', 'flags']
+HISTORY_FLAG_STALE = 0x01
+HISTORY_COMMAND = 'history/get'
+
+history_fd = -1
+history_nbr_records = 0
+history_next_slot = 0
+history_next_sequence = 1
+history_lock = threading.Lock()
+
+def readHistorySlots(historyData, nbrRecords):
+    # return [(sequence, slot)] of the used records in historyData, oldest first
+    usedSlots = []
+    for slot in range(nbrRecords):
+        sequence = HISTORY_RECORD.unpack_from(historyData, slot * HISTORY_RECORD.size)[0]
+        if sequence != 0:
+            usedSlots.append((sequence, slot))
+    return sorted(usedSlots)
+
+def openHistory():
+    # open our history file, creating it when missing or resizing it (keeping the newest records)
+    #  NOTE: there is no header, we find our newest record by its sequence number so each
+    #  sample rewrites only its own record (kernel writeback does the flash writes). We use
+    #  pread/pwrite, not mmap: JFFS2 (the Omega2 overlay) has no shared writable mappings
+    global history_fd
+    global history_nbr_records
+    global history_next_slot
+    global history_next_sequence
+    if history_filespec == '':
+        return
+    history_nbr_records = int(history_days * 24 * 60 / interval_in_minutes)
+    fileSize = history_nbr_records * HISTORY_RECORD.size
+    try:
+        history_fd = os.open(history_filespec, os.O_RDWR | os.O_CREAT, 0o600)
+        priorFileSize = os.fstat(history_fd).st_size
+        if priorFileSize != fileSize:
+            # e.g. interval or days changed: rewrite the newest records that still fit, in order
+            priorData = os.pread(history_fd, priorFileSize, 0)
+            priorNbrRecords = priorFileSize // HISTORY_RECORD.size
+            keptSlots = readHistorySlots(priorData, priorNbrRecords)[-history_nbr_records:]
+            resizedData = bytearray(fileSize)
+            for [newSlot, [_, priorSlot]] in enumerate(keptSlots):
+                resizedData[newSlot * HISTORY_RECORD.size:(newSlot + 1) * HISTORY_RECORD.size] = priorData[priorSlot * HISTORY_RECORD.size:(priorSlot + 1) * HISTORY_RECORD.size]
+            os.ftruncate(history_fd, fileSize)
+            os.pwrite(history_fd, bytes(resizedData), 0)
+            if priorFileSize > 0:
+                print_line('History file [{}] resized to {} records, kept {}'.format(history_filespec, history_nbr_records, len(keptSlots)), verbose=True)
+        historyData = os.pread(history_fd, fileSize, 0)
+    except OSError as openErr:
+        print_line('History file [{}] not available ({}), history disabled'.format(history_filespec, openErr), warning=True)
+        closeHistory()
+        return
+    usedSlots = readHistorySlots(historyData, history_nbr_records)
+    history_next_slot = 0
+    history_next_sequence = 1
+    if len(usedSlots) > 0:
+        newestSequence, newestSlot = usedSlots[-1]
+        history_next_slot = (newestSlot + 1) % history_nbr_records
+        history_next_sequence = newestSequence + 1
+    print_line('- history [{}] {} records, next slot=[{}]'.format(history_filespec, history_nbr_records, history_next_slot), debug=True)
+
+def closeHistory():
+    global history_fd
+    if history_fd != -1:
+        with history_lock:
+            os.close(history_fd)
+            history_fd = -1
+
+def appendHistoryRecord(timestamp):
+    global history_next_slot
+    global history_next_sequence
+    if history_fd == -1:
+        return
+    memAvailKb = 0
+    if dvc_memory_tuple != '' and dvc_memory_tuple[2] != '':
+        memAvailKb = int(dvc_memory_tuple[2] * 1024)
+    fsUsedPercent = 0
+    if dvc_filesystem_percent != '':
+        fsUsedPercent = min(int(dvc_filesystem_percent), 255)
+    loads = [min(int(load * 100), 0xffff) for load in os.getloadavg()]
+    flags = HISTORY_FLAG_STALE if len(dvc_stale_collectors) > 0 else 0
+    with history_lock:
+        try:
+            os.pwrite(history_fd, HISTORY_RECORD.pack(history_next_sequence, int(timestamp.timestamp()), memAvailKb, loads[0], loads[1], loads[2], fsUsedPercent, flags),
+                history_next_slot * HISTORY_RECORD.size)
+        except OSError as writeErr:
+            print_line('History file [{}] write failed ({})'.format(history_filespec, writeErr), warning=True)
+            return
+        history_next_slot = (history_next_slot + 1) % history_nbr_records
+        history_next_sequence += 1
+
+def readHistory(fromTime, toTime):
+    # return our records (oldest first) within [fromTime, toTime] as lists of HISTORY_FIELDS values
+    records = []
+    if history_fd == -1:
+        return records
+    with history_lock:
+        historyData = os.pread(history_fd, history_nbr_records * HISTORY_RECORD.size, 0)
+        for index in range(history_nbr_records):
+            slot = (history_next_slot + index) % history_nbr_records
+            record = HISTORY_RECORD.unpack_from(historyData, slot * HISTORY_RECORD.size)
+            if record[0] != 0 and fromTime <= record[1] <= toTime:
+                records.append(list(record[1:]))
+    return records
+
+def parseHistoryTime(value, defaultTime):
+    # accept epoch seconds or an ISO 8601 date/time
+    if value is None or value == '':
+        return defaultTime
+    if isinstance(value, (int, float)):
+        return int(value)
+    try:
+        return int(datetime.fromisoformat(value).timestamp())
+    except ValueError:
+        return int(value)
+
+def handleHistoryRequest(payload):
+    # payload: {"from": .., "to": .., "id": ..} all optional, times as epoch seconds or ISO 8601
+    try:
+        request = json.loads(payload) if payload.strip() != '' else {}
+        fromTime = parseHistoryTime(request.get('from'), 0)
+        toTime = parseHistoryTime(request.get('to'), int(time()))
+    except (ValueError, TypeError, AttributeError):
+        print_line('Bad history request [{}], ignored'.format(payload), warning=True)
+        return
+    _thread.start_new_thread(publishHistory, (fromTime, toTime, request.get('id', '')))
+
+def publishHistory(fromTime, toTime, requestID):
+    records = readHistory(fromTime, toTime)
+    nbrChunks = max(1, -(-len(records) // history_chunk_records))
+    print_line('Publishing {} history records in {} chunk(s) to MQTT topic "{}"'.format(len(records), nbrChunks, history_topic), verbose=True)
+    for chunkIndex in range(nbrChunks):
+        historyData = OrderedDict()
+        if requestID != '':
+            historyData[HIST_REQUEST_ID] = requestID
+        historyData[HIST_FROM] = fromTime
+        historyData[HIST_TO] = toTime
+        historyData[HIST_CHUNK] = chunkIndex + 1
+        historyData[HIST_CHUNKS] = nbrChunks
+        historyData[HIST_FIELDS] = HISTORY_FIELDS
+        historyData[HIST_RECORDS] = records[chunkIndex * history_chunk_records:(chunkIndex + 1) * history_chunk_records]
+        historyTopDict = OrderedDict()
+        historyTopDict[LDS_HISTORY_PAYLOAD_NAME] = historyData
+        publishToTopic(history_topic, json.dumps(historyTopDict, separators=(',', ':')), 1, retain=False)
+
+def startHistory():
+    openHistory()
+    if history_fd != -1:
+        addCommandHandler(HISTORY_COMMAND, handleHistoryRequest)
+
+# -----------------------------------------------------------------------------
+#  configuration reload (SIGHUP or command topic), applied in place
+# -----------------------------------------------------------------------------
+
+RELOAD_INTERRUPT = (-5)
+RELOAD_COMMAND = 'reload'
+
+reload_lock = threading.Lock()
+
+def reloadConfiguration():
+    # re-read config.ini and apply what changed, reconnecting and re-announcing only when
+    #  broker or topic settings changed (our collected device facts are kept)
+    global config
+    with reload_lock:
+        print_line('* Reloading configuration file "config.ini" ...', verbose=True)
+        newConfig, configError = loadConfigFile()
+        if newConfig is None:
+            print_line('ERROR: {} Reload ignored, keeping current settings'.format(configError), error=True, sd_notify=True)
+            return
+        newSettings, configError = getReloadableSettings(newConfig)
+        if newSettings is None:
+            print_line('ERROR: {} Reload ignored, keeping current settings'.format(configError), error=True, sd_notify=True)
+            return
+        changedSettings = [name for name in newSettings if newSettings[name] != reloadable_settings[name]]
+        if len(changedSettings) == 0:
+            print_line('* Configuration unchanged', verbose=True)
+            return
+        print_line('* Configuration changed: {}'.format(', '.join(changedSettings)), sd_notify=True)
+        priorSensorName = sensor_name
+        priorLwtTopic = lwt_topic
+        config = newConfig
+        applyReloadableSettings(newSettings)
+
+        topicsChanged = 'base_topic' in changedSettings or 'sensor_name' in changedSettings
+        if topicsChanged:
+            setupTopics()
+            # our clean disconnect won't trigger the LWT, so replace our retained 'online' ourselves
+            mqtt_client.publish(priorLwtTopic, lwt_offline_val, 1, retain=True)
+        if topicsChanged or 'mqtt_broker' in changedSettings:
+            # our LWT topic is part of the connection so a topic change reconnects, too
+            stopMqttClient()
+            if not startMqttClient():
+                os._exit(1)     # let procd restart us
+        if topicsChanged:
+            clearDiscovery(priorSensorName)
+            publishDiscovery()
+
+        if 'interval_in_minutes' in changedSettings or 'report_schedule' in changedSettings:
+            startPeriodTimer()
+        if 'heartbeat_interval_in_seconds' in changedSettings:
+            startAliveTimer()
+        if 'alert_thresholds' in changedSettings or 'alert_sample_interval_in_seconds' in changedSettings:
+            for stateKey in list(alert_raised):
+                if stateKey not in alert_thresholds and stateKey.partition('@')[0] not in alert_thresholds:
+                    del alert_raised[stateKey]
+            stopAlertSampleTimer()
+            startAlertSampleTimer()
+    if topicsChanged:
+        handle_interrupt(RELOAD_INTERRUPT)  # report on our new topics right away
+
+def handleReloadRequest(payload):
+    _thread.start_new_thread(reloadConfiguration, ())
+
+def sighupHandler(signum, frame):
+    _thread.start_new_thread(reloadConfiguration, ())
+
+def startReloadHandling():
+    signal(SIGHUP, sighupHandler)
+    addCommandHandler(RELOAD_COMMAND, handleReloadRequest)
+    if reload_requested_during_startup:
+        print_line('* Reload requested during startup, reloading now', verbose=True)
+        _thread.start_new_thread(reloadConfiguration, ())
+
+# Event handler - refresh only what changed, then report
+def handle_event(sources):
+    global reported_first_time
+    sourceID = "<< EVENT(" + ','.join(sorted(sources)) + ")"
+    current_timestamp = datetime.now(local_tz)
+    if not startCycle():
+        # a cycle is running, try again a bit later
+        print_line(sourceID + " >> Change detected, report cycle busy, retrying", debug=True)
+        for source in sources:
+            queueEvent(source)
+        return
+    try:
+        print_line(sourceID + " >> Change detected, reporting! (%s)" % current_timestamp.strftime('%H:%M:%S - %Y/%m/%d'), verbose=True)
+        if EVENT_SRC_UPDATE_DATES in sources:
+            getLastUpdateDate()
+        if EVENT_SRC_NETWORK in sources:
+            runCollector(getNetworkIFs)
+
+        if (opt_stall == False or reported_first_time == False and opt_stall == True):
+            _thread.start_new_thread(send_status, (current_timestamp, ''))
+            reported_first_time = True
+        else:
+            print_line(sourceID + " >> Change detected but SKIPPED (TEST: stall)", verbose=True)
+    finally:
+        endCycle()
 
 def afterMQTTConnect():
     print_line('* afterMQTTConnect()', verbose=True)
@@ -954,14 +2702,20 @@ def afterMQTTConnect():
     handle_interrupt(0)
 
 # TESTING AGAIN
-getNetworkIFs()
+runCollector(getNetworkIFs)
 #getLastUpdateDate()
 
 # TESTING, early abort
 #stopAliveTimer()
 #exit(0)
 
+startHistory()
+startOutputSinks()
+startReloadHandling()
 afterMQTTConnect()  # now instead of after?
+startEventTriggers()
+startAlertSampleTimer()
+startWatchdogTimer()
 
 # now just hang in forever loop until script is stopped externally
 try:
@@ -973,4 +2727,8 @@ finally:
     # cleanup used pins... just because we like cleaning up after us
     stopPeriodTimer()   # don't leave our timers running!
     stopAliveTimer()
+    stopEventTriggers()
+    stopAlertSampleTimer()
+    stopWatchdogTimer()
+    closeHistory()
 
@@ -0,0 +1,665 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Report cycle benchmark for ISP-Omega2-mqtt-daemon.py
+#
+#  Runs the daemon in-process against a stand-in MQTT broker with its shell commands answered
+#  from fixtures (bench/fixtures/), then times full report cycles: from the period timer tick
+#  (periodTimeoutHandler) through update_values(), send_status() and publishMonitorData() to
+#  the broker's PUBACK of our monitor report (with --protocol 5 the report goes out at QoS 0,
+#  so to paho handing it to the socket).
+#
+#  Reports per cycle: latency percentiles, CPU time (whole process, our stand-in broker
+#  included), memory allocated (tracemalloc peak, in a separate pass as tracing slows us down)
+#  and threads started. Compare against a baseline file to judge a change on numbers:
+#
+#    python3 bench/cycle-bench.py --save-baseline        # before your change
+#    python3 bench/cycle-bench.py --max-regression 10    # after, fails if >10% worse
+#
+#  With --tls the stand-in broker speaks TLS (self-signed cert made with openssl in the temp
+#  dir), drops the connection after the warm-up and we check the daemon's reconnect resumed
+#  its TLS session instead of doing another full handshake.
+#
+#  With --ubus the daemon reads system board/info from a stand-in ubusd serving the JSON
+#  fixtures, and we check it decoded them (--ubus denied: that it fell back to its commands).
+#
+#  Cycles are run one after another once the prior cycle's threads are done, so expect about
+#  half a second per cycle (publishMonitorData() waits that long after publishing).
+
+import _thread
+import threading
+import socket
+import struct
+import argparse
+import json
+import os
+import platform
+import select
+import ssl
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from time import perf_counter, process_time, sleep
+from collections import OrderedDict
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+daemon_filespec = os.path.join(os.path.dirname(bench_dir), 'ISP-Omega2-mqtt-daemon.py')
+fixtures_dir = os.path.join(bench_dir, 'fixtures')
+default_baseline_filespec = os.path.join(bench_dir, 'cycle-baseline.json')
+
+# where we take control of the daemon's startup (see loadDaemon())
+DAEMON_FIXTURES_MARKER = 'def runCollector(collector):'
+DAEMON_MAIN_LOOP_MARKER = '# now just hang in forever loop'
+
+# command (part of) -> fixture file holding its output, as seen on an Omega2+
+COMMAND_FIXTURES = [
+    ("/proc/cpuinfo | egrep", 'cpuinfo-system-cpu-bogo.txt'),
+    ("/proc/cpuinfo | grep machine", 'cpuinfo-machine.txt'),
+    ("/proc/meminfo", 'meminfo.txt'),
+    ("uname -r", 'uname-r.txt'),
+    ("uname -m", 'uname-m.txt'),
+    ("/etc/config/system", 'system-hostname.txt'),
+    ("/usr/bin/uptime", 'uptime.txt'),
+    ("/sbin/ifconfig", 'ifconfig.txt'),
+    ("/bin/df", 'df.txt'),
+    ("oupgrade", 'oupgrade.txt'),
+]
+
+PUBACK_TIMEOUT_IN_SECONDS = 10
+RECONNECT_TIMEOUT_IN_SECONDS = 15
+
+# metrics checked by --max-regression (the latency tail is shown but too noisy to fail on)
+GATED_METRICS = ['latency_p50_ms', 'cpu_p50_ms', 'alloc_peak_p50_kib', 'threads_per_cycle']
+
+# -----------------------------------------------------------------------------
+#  stand-in MQTT broker: just enough of MQTT v3.1.1 and v5 for the daemon
+# -----------------------------------------------------------------------------
+
+MQTT_CONNECT = 1
+MQTT_PUBLISH = 3
+MQTT_SUBSCRIBE = 8
+MQTT_UNSUBSCRIBE = 10
+MQTT_PINGREQ = 12
+MQTT_DISCONNECT = 14
+
+class FakeBroker:
+    def __init__(self, tlsContext=None):
+        self.listenSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listenSocket.bind(('127.0.0.1', 0))
+        self.listenSocket.listen(5)
+        self.port = self.listenSocket.getsockname()[1]
+        self.tlsContext = tlsContext
+        self.clientSockets = []
+        self.socketsToDrop = []
+        self.publishCount = 0
+        self.publishBytes = 0
+
+    def start(self):
+        thread = threading.Thread(target=self.acceptLoop, daemon=True)
+        thread.start()
+
+    def acceptLoop(self):
+        while True:
+            clientSocket, _ = self.listenSocket.accept()
+            clientSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            thread = threading.Thread(target=self.clientLoop, args=(clientSocket,), daemon=True)
+            thread.start()
+
+    def dropClients(self):
+        # as if the broker went away, the daemon has to reconnect
+        #  (each clientLoop closes its own socket, a shutdown() from here has OpenSSL answer
+        #  with alerts the daemon's paho doesn't survive)
+        self.socketsToDrop = list(self.clientSockets)
+
+    def waitReadable(self, clientSocket):
+        # returns False if we are to drop this client
+        while clientSocket not in self.socketsToDrop:
+            if isinstance(clientSocket, ssl.SSLSocket) and clientSocket.pending() > 0:
+                return True
+            readable, _, _ = select.select([clientSocket], [], [], 0.1)
+            if len(readable) > 0:
+                return True
+        return False
+
+    def recvExactly(self, clientSocket, nbrBytes):
+        data = b''
+        while len(data) < nbrBytes:
+            chunk = clientSocket.recv(nbrBytes - len(data))
+            if len(chunk) == 0:
+                raise EOFError
+            data += chunk
+        return data
+
+    def recvPacket(self, clientSocket):
+        header = self.recvExactly(clientSocket, 1)[0]
+        length = 0
+        multiplier = 1
+        while True:
+            lengthByte = self.recvExactly(clientSocket, 1)[0]
+            length += (lengthByte & 0x7f) * multiplier
+            multiplier *= 128
+            if lengthByte & 0x80 == 0:
+                break
+        return header, self.recvExactly(clientSocket, length)
+
+    def clientLoop(self, clientSocket):
+        protocolLevel = 4
+        try:
+            if self.tlsContext is not None:
+                clientSocket = self.tlsContext.wrap_socket(clientSocket, server_side=True)
+            self.clientSockets.append(clientSocket)
+            while self.waitReadable(clientSocket):
+                header, body = self.recvPacket(clientSocket)
+                packetType = header >> 4
+                if packetType == MQTT_CONNECT:
+                    nameLen = struct.unpack_from('>H', body, 0)[0]
+                    protocolLevel = body[2 + nameLen]
+                    if protocolLevel == 5:
+                        # accepted, TopicAliasMaximum = 10
+                        clientSocket.sendall(bytes([0x20, 6, 0, 0, 3, 0x22, 0, 10]))
+                    else:
+                        clientSocket.sendall(bytes([0x20, 2, 0, 0]))
+                elif packetType == MQTT_PUBLISH:
+                    self.publishCount += 1
+                    self.publishBytes += len(body)
+                    qos = (header >> 1) & 3
+                    if qos > 0:
+                        topicLen = struct.unpack_from('>H', body, 0)[0]
+                        packetID = body[2 + topicLen:4 + topicLen]
+                        clientSocket.sendall(bytes([0x40, 2]) + packetID)
+                elif packetType == MQTT_SUBSCRIBE:
+                    packetID = body[0:2]
+                    if protocolLevel == 5:
+                        clientSocket.sendall(bytes([0x90, 4]) + packetID + bytes([0, 1]))
+                    else:
+                        clientSocket.sendall(bytes([0x90, 3]) + packetID + bytes([1]))
+                elif packetType == MQTT_UNSUBSCRIBE:
+                    packetID = body[0:2]
+                    if protocolLevel == 5:
+                        clientSocket.sendall(bytes([0xb0, 4]) + packetID + bytes([0, 0]))
+                    else:
+                        clientSocket.sendall(bytes([0xb0, 2]) + packetID)
+                elif packetType == MQTT_PINGREQ:
+                    clientSocket.sendall(bytes([0xd0, 0]))
+                elif packetType == MQTT_DISCONNECT:
+                    break
+        except (EOFError, OSError):
+            pass
+        if clientSocket in self.clientSockets:
+            self.clientSockets.remove(clientSocket)
+        clientSocket.close()
+
+def makeTlsFiles(configDir):
+    # self-signed cert for our stand-in broker, the daemon trusts it as its CA
+    #  returns (certfile, keyfile)
+    certFilespec = os.path.join(configDir, 'broker-cert.pem')
+    keyFilespec = os.path.join(configDir, 'broker-key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1', '-nodes',
+                    '-days', '1', '-subj', '/CN=127.0.0.1', '-addext', 'subjectAltName=IP:127.0.0.1',
+                    '-keyout', keyFilespec, '-out', certFilespec], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certFilespec, keyFilespec
+
+def forceReconnect(daemon, broker):
+    # drop the daemon's connection and wait until it is back (a new TLS handshake done)
+    handshakesBefore = daemon['tls_handshake_count']
+    broker.dropClients()
+    waitStartTime = perf_counter()
+    while daemon['tls_handshake_count'] == handshakesBefore or not daemon['mqtt_client_connected']:
+        if perf_counter() - waitStartTime > RECONNECT_TIMEOUT_IN_SECONDS:
+            raise RuntimeError('Daemon did not reconnect within {} seconds'.format(RECONNECT_TIMEOUT_IN_SECONDS))
+        sleep(0.1)
+
+# -----------------------------------------------------------------------------
+#  stand-in ubusd: answers 'system board' and 'system info' from our JSON fixtures
+# -----------------------------------------------------------------------------
+
+UBUS_MSG_HELLO = 0
+UBUS_MSG_STATUS = 1
+UBUS_MSG_DATA = 2
+UBUS_MSG_LOOKUP = 4
+UBUS_MSG_INVOKE = 5
+UBUS_ATTR_STATUS = 1
+UBUS_ATTR_OBJPATH = 2
+UBUS_ATTR_OBJID = 3
+UBUS_ATTR_METHOD = 4
+UBUS_ATTR_DATA = 7
+UBUS_STATUS_METHOD_NOT_FOUND = 3
+UBUS_STATUS_NOT_FOUND = 4
+UBUS_STATUS_PERMISSION_DENIED = 6
+UBUS_MSG_HDR = struct.Struct('>BBHI')
+UBUS_SYSTEM_OBJID = 0x1d3e5f7a
+
+BLOBMSG_TYPE_ARRAY = 1
+BLOBMSG_TYPE_TABLE = 2
+BLOBMSG_TYPE_STRING = 3
+BLOBMSG_TYPE_INT64 = 4
+BLOBMSG_TYPE_INT32 = 5
+BLOBMSG_TYPE_BOOL = 7
+BLOBMSG_TYPE_DOUBLE = 8
+
+UBUS_METHOD_FIXTURES = OrderedDict([('board', 'ubus-system-board.json'), ('info', 'ubus-system-info.json')])
+
+def blobPadLen(length):
+    return (length + 3) & ~3
+
+def blobAttr(attrId, payload, extended=False):
+    length = 4 + len(payload)
+    header = (0x80000000 if extended else 0) | (attrId << 24) | length
+    return struct.pack('>I', header) + payload + b'\0' * (blobPadLen(length) - length)
+
+def blobmsgAttr(name, value):
+    # encode value the way ubusd's clients (blobmsg_add_json) would
+    nameBytes = name.encode('utf-8')
+    nameHeader = struct.pack('>H', len(nameBytes)) + nameBytes + b'\0'
+    nameHeader += b'\0' * (blobPadLen(len(nameHeader)) - len(nameHeader))
+    if isinstance(value, bool):
+        msgType, payload = BLOBMSG_TYPE_BOOL, bytes([1 if value else 0])
+    elif isinstance(value, int):
+        if -2**31 <= value < 2**31:
+            msgType, payload = BLOBMSG_TYPE_INT32, struct.pack('>i', value)
+        else:
+            msgType, payload = BLOBMSG_TYPE_INT64, struct.pack('>q', value)
+    elif isinstance(value, float):
+        msgType, payload = BLOBMSG_TYPE_DOUBLE, struct.pack('>d', value)
+    elif isinstance(value, dict):
+        msgType, payload = BLOBMSG_TYPE_TABLE, blobmsgTable(value)
+    elif isinstance(value, list):
+        msgType, payload = BLOBMSG_TYPE_ARRAY, b''.join(blobmsgAttr('', item) for item in value)
+    else:
+        msgType, payload = BLOBMSG_TYPE_STRING, str(value).encode('utf-8') + b'\0'
+    return blobAttr(msgType, nameHeader + payload, extended=True)
+
+def blobmsgTable(table):
+    return b''.join(blobmsgAttr(name, value) for [name, value] in table.items())
+
+def loadUbusFixture(method):
+    with open(os.path.join(fixtures_dir, UBUS_METHOD_FIXTURES[method])) as fixtureFile:
+        return json.load(fixtureFile, object_pairs_hook=OrderedDict)
+
+class FakeUbusd:
+    def __init__(self, socketSpec, deny=False):
+        self.socketSpec = socketSpec
+        self.deny = deny
+        self.invokeCounts = OrderedDict([(method, 0) for method in UBUS_METHOD_FIXTURES])
+        self.listenSocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listenSocket.bind(socketSpec)
+        self.listenSocket.listen(5)
+
+    def start(self):
+        thread = threading.Thread(target=self.acceptLoop, daemon=True)
+        thread.start()
+
+    def stop(self):
+        self.listenSocket.close()
+        os.remove(self.socketSpec)
+
+    def acceptLoop(self):
+        while True:
+            try:
+                clientSocket, _ = self.listenSocket.accept()
+            except OSError:
+                return
+            thread = threading.Thread(target=self.clientLoop, args=(clientSocket,), daemon=True)
+            thread.start()
+
+    def recvExactly(self, clientSocket, nbrBytes):
+        data = b''
+        while len(data) < nbrBytes:
+            chunk = clientSocket.recv(nbrBytes - len(data))
+            if len(chunk) == 0:
+                raise EOFError
+            data += chunk
+        return data
+
+    def sendMessage(self, clientSocket, msgType, seq, attrs):
+        clientSocket.sendall(UBUS_MSG_HDR.pack(0, msgType, seq, 0) + blobAttr(0, b''.join(attrs)))
+
+    def sendStatus(self, clientSocket, seq, status):
+        self.sendMessage(clientSocket, UBUS_MSG_STATUS, seq, [blobAttr(UBUS_ATTR_STATUS, struct.pack('>i', status))])
+
+    def clientLoop(self, clientSocket):
+        try:
+            self.sendMessage(clientSocket, UBUS_MSG_HELLO, 0, [])
+            while True:
+                header = self.recvExactly(clientSocket, UBUS_MSG_HDR.size + 4)
+                _, msgType, seq, _ = UBUS_MSG_HDR.unpack_from(header, 0)
+                length = struct.unpack_from('>I', header, UBUS_MSG_HDR.size)[0] & 0x00ffffff
+                body = self.recvExactly(clientSocket, length - 4)
+                attrs = {}
+                offset = 0
+                while offset + 4 <= len(body):
+                    attrHeader = struct.unpack_from('>I', body, offset)[0]
+                    attrLength = attrHeader & 0x00ffffff
+                    attrs[(attrHeader >> 24) & 0x7f] = body[offset + 4:offset + attrLength]
+                    offset += blobPadLen(attrLength)
+                if msgType == UBUS_MSG_LOOKUP:
+                    if attrs.get(UBUS_ATTR_OBJPATH, b'').rstrip(b'\0') != b'system':
+                        self.sendStatus(clientSocket, seq, UBUS_STATUS_NOT_FOUND)
+                        continue
+                    self.sendMessage(clientSocket, UBUS_MSG_DATA, seq, [blobAttr(UBUS_ATTR_OBJPATH, b'system\0'), blobAttr(UBUS_ATTR_OBJID, struct.pack('>I', UBUS_SYSTEM_OBJID))])
+                    self.sendStatus(clientSocket, seq, 0)
+                elif msgType == UBUS_MSG_INVOKE:
+                    method = attrs.get(UBUS_ATTR_METHOD, b'').rstrip(b'\0').decode('utf-8')
+                    if self.deny:
+                        self.sendStatus(clientSocket, seq, UBUS_STATUS_PERMISSION_DENIED)
+                        continue
+                    if method not in UBUS_METHOD_FIXTURES:
+                        self.sendStatus(clientSocket, seq, UBUS_STATUS_METHOD_NOT_FOUND)
+                        continue
+                    self.invokeCounts[method] += 1
+                    self.sendMessage(clientSocket, UBUS_MSG_DATA, seq, [blobAttr(UBUS_ATTR_OBJID, struct.pack('>I', UBUS_SYSTEM_OBJID)), blobAttr(UBUS_ATTR_DATA, blobmsgTable(loadUbusFixture(method)))])
+                    self.sendStatus(clientSocket, seq, 0)
+        except (EOFError, OSError):
+            pass
+        clientSocket.close()
+
+def checkUbusValues(daemon, ubusd):
+    # returns a list of problems with what the daemon got from our stand-in ubusd
+    problems = []
+    if ubusd.deny:
+        if daemon['ubus_socket_spec'] != '':
+            problems.append('daemon did not fall back to its commands when ubusd denied access')
+        if daemon['dvc_model'] != 'Onion Omega2+':
+            problems.append('dvc_model=[{}] not from the cpuinfo fixture'.format(daemon['dvc_model']))
+        return problems
+    board = loadUbusFixture('board')
+    info = loadUbusFixture('info')
+    expectedValues = OrderedDict([
+        ('ubus_socket_spec', ubusd.socketSpec),
+        ('dvc_model', board['model']),
+        ('dvc_hostname', board['hostname']),
+        ('dvc_linux_release', board['release']['distribution']),
+        ('dvc_linux_version', board['kernel']),
+        ('dvc_uptime', '1 day'),    # 97213 sec
+        ('dvc_memory_tuple', (info['memory']['total'] / 1048576, info['memory']['free'] / 1048576, info['memory']['available'] / 1048576)),
+    ])
+    for [name, expectedValue] in expectedValues.items():
+        if daemon[name] != expectedValue:
+            problems.append('{}=[{}], expected [{}]'.format(name, daemon[name], expectedValue))
+    if ubusd.invokeCounts['board'] != 1:
+        problems.append('system board called {} times, expected once at startup'.format(ubusd.invokeCounts['board']))
+    if ubusd.invokeCounts['info'] < 2:
+        problems.append('system info called {} times, expected every report'.format(ubusd.invokeCounts['info']))
+    return problems
+
+# -----------------------------------------------------------------------------
+#  thread accounting: every thread the daemon starts goes through one of these
+# -----------------------------------------------------------------------------
+
+threads_started = 0
+raw_threads_running = 0
+thread_count_lock = threading.Lock()
+original_start_new_thread = _thread.start_new_thread
+original_thread_start = threading.Thread.start
+
+def countingStartNewThread(function, args, kwargs={}):
+    global threads_started
+    global raw_threads_running
+    def runCounted():
+        global raw_threads_running
+        try:
+            function(*args, **kwargs)
+        finally:
+            with thread_count_lock:
+                raw_threads_running -= 1
+    with thread_count_lock:
+        threads_started += 1
+        raw_threads_running += 1
+    return original_start_new_thread(runCounted, ())
+
+def countingThreadStart(self):
+    global threads_started
+    with thread_count_lock:
+        threads_started += 1
+    original_thread_start(self)
+
+def waitForRawThreads():
+    # let the prior cycle's send_status/publish threads finish (publishMonitorData sleeps a bit)
+    while raw_threads_running > 0:
+        sleep(0.01)
+
+# -----------------------------------------------------------------------------
+#  the daemon, in-process
+# -----------------------------------------------------------------------------
+
+def fixtureCommand(command):
+    # stands in for the daemon's runCommand()
+    for [commandPart, fixtureName] in COMMAND_FIXTURES:
+        if commandPart in command:
+            with open(os.path.join(fixtures_dir, fixtureName), 'rb') as fixtureFile:
+                return fixtureFile.read()
+    raise RuntimeError('No fixture for command [{}], add one to COMMAND_FIXTURES'.format(command))
+
+def writeConfig(configDir, brokerPort, protocol, ubusSocketSpec, caCertFilespec):
+    tlsSettings = ['tls = true', 'tls_ca_cert = {}'.format(caCertFilespec)] if caCertFilespec is not None else []
+    with open(os.path.join(configDir, 'config.ini'), 'w') as configFile:
+        configFile.write('\n'.join([
+            '[Daemon]',
+            'interval_in_minutes = 30',     # we tick ourselves
+            'event_triggers = false',
+            'ubus_socket = {}'.format(ubusSocketSpec),
+            '[MQTT]',
+            'hostname = 127.0.0.1',
+            'port = {}'.format(brokerPort),
+            'protocol = {}'.format(protocol),
+            'base_topic = bench',
+            'sensor_name = omega2-bench',
+        ] + tlsSettings + ['']))
+
+def loadDaemon(configDir):
+    # run the daemon's startup with our fixtures in place of its commands, up to its main loop
+    with open(daemon_filespec) as daemonFile:
+        source = daemonFile.read()
+    fixturesAt = source.index(DAEMON_FIXTURES_MARKER)
+    mainLoopAt = source.index(DAEMON_MAIN_LOOP_MARKER)
+    daemon = {'__name__': 'omega2_daemon', '__file__': daemon_filespec}
+    sys.argv = [daemon_filespec, '-c', configDir]
+    exec(compile(source[:fixturesAt], daemon_filespec, 'exec'), daemon)
+    daemon['runCommand'] = fixtureCommand
+    # keep line numbers right for tracebacks
+    padding = '\n' * source[:fixturesAt].count('\n')
+    exec(compile(padding + source[fixturesAt:mainLoopAt], daemon_filespec, 'exec'), daemon)
+    return daemon
+
+class PubackWatcher:
+    # notes our monitor report's message id and when its PUBACK came in
+    def __init__(self, daemon):
+        self.daemon = daemon
+        self.condition = threading.Condition()
+        self.monitorMids = []
+        self.ackTimes = {}
+        self.priorOnPublish = daemon['mqtt_client'].on_publish
+        daemon['mqtt_client'].on_publish = self.onPublish
+        self.priorPublishToTopic = daemon['publishToTopic']
+        daemon['publishToTopic'] = self.publishToTopic
+
+    def onPublish(self, client, userdata, mid):
+        with self.condition:
+            self.ackTimes[mid] = perf_counter()
+            self.condition.notify_all()
+        self.priorOnPublish(client, userdata, mid)
+
+    def publishToTopic(self, topic, *args, **kwargs):
+        messageInfo = self.priorPublishToTopic(topic, *args, **kwargs)
+        if topic == self.daemon['values_topic']:
+            with self.condition:
+                self.monitorMids.append(messageInfo.mid)
+                self.condition.notify_all()
+        return messageInfo
+
+    def waitForPuback(self, nbrPriorReports):
+        # returns when our next monitor report was acknowledged
+        with self.condition:
+            acked = self.condition.wait_for(lambda: len(self.monitorMids) > nbrPriorReports and self.monitorMids[nbrPriorReports] in self.ackTimes, PUBACK_TIMEOUT_IN_SECONDS)
+            if not acked:
+                raise RuntimeError('No PUBACK for our monitor report within {} seconds (see the daemon errors above)'.format(PUBACK_TIMEOUT_IN_SECONDS))
+            return self.ackTimes[self.monitorMids[nbrPriorReports]]
+
+def runCycles(daemon, watcher, nbrCycles, traceAllocations):
+    # returns a list of per-cycle results
+    cycleResults = []
+    for _ in range(nbrCycles):
+        waitForRawThreads()
+        nbrPriorReports = len(watcher.monitorMids)
+        threadsBefore = threads_started
+        if traceAllocations:
+            tracemalloc.reset_peak()
+            tracedBefore, _ = tracemalloc.get_traced_memory()
+        cpuBefore = process_time()
+        tickTime = perf_counter()
+        daemon['periodTimeoutHandler']()
+        ackTime = watcher.waitForPuback(nbrPriorReports)
+        cycleResult = OrderedDict()
+        cycleResult['latency_ms'] = (ackTime - tickTime) * 1000
+        cycleResult['cpu_ms'] = (process_time() - cpuBefore) * 1000
+        cycleResult['threads'] = threads_started - threadsBefore
+        if traceAllocations:
+            _, tracedPeak = tracemalloc.get_traced_memory()
+            cycleResult['alloc_peak_kib'] = (tracedPeak - tracedBefore) / 1024
+        cycleResults.append(cycleResult)
+    waitForRawThreads()
+    return cycleResults
+
+def stopDaemon(daemon):
+    for stopFunction in ['stopPeriodTimer', 'stopAliveTimer', 'stopEventTriggers', 'stopAlertSampleTimer', 'stopWatchdogTimer', 'closeHistory', 'stopMqttClient']:
+        daemon[stopFunction]()
+
+# -----------------------------------------------------------------------------
+#  results
+# -----------------------------------------------------------------------------
+
+def percentile(values, percent):
+    # nearest-rank
+    orderedValues = sorted(values)
+    rank = max(int(round(percent / 100.0 * len(orderedValues) + 0.5)) - 1, 0)
+    return orderedValues[min(rank, len(orderedValues) - 1)]
+
+def summarize(timedResults, allocResults):
+    latencies = [result['latency_ms'] for result in timedResults]
+    summary = OrderedDict()
+    summary['latency_p50_ms'] = round(percentile(latencies, 50), 3)
+    summary['latency_p90_ms'] = round(percentile(latencies, 90), 3)
+    summary['latency_p99_ms'] = round(percentile(latencies, 99), 3)
+    summary['latency_max_ms'] = round(max(latencies), 3)
+    summary['cpu_p50_ms'] = round(percentile([result['cpu_ms'] for result in timedResults], 50), 3)
+    summary['cpu_mean_ms'] = round(sum(result['cpu_ms'] for result in timedResults) / len(timedResults), 3)
+    summary['alloc_peak_p50_kib'] = round(percentile([result['alloc_peak_kib'] for result in allocResults], 50), 1)
+    summary['threads_per_cycle'] = round(sum(result['threads'] for result in timedResults) / len(timedResults), 2)
+    return summary
+
+def getHostInfo(protocol, tls, collectors):
+    hostInfo = OrderedDict()
+    hostInfo['machine'] = platform.machine()
+    hostInfo['python'] = platform.python_version()
+    hostInfo['protocol'] = protocol
+    hostInfo['tls'] = tls
+    hostInfo['collectors'] = collectors
+    return hostInfo
+
+def compareToBaseline(summary, hostInfo, baselineFilespec, maxRegressionPrcnt):
+    # returns False if a metric regressed more than allowed
+    with open(baselineFilespec) as baselineFile:
+        baseline = json.load(baselineFile)
+    if baseline.get('host') != hostInfo:
+        print('NOTE: baseline was taken on {}, this run is on {}'.format(json.dumps(baseline.get('host')), json.dumps(hostInfo)))
+    withinLimits = True
+    print('{:<22} {:>12} {:>12} {:>9}'.format('', 'baseline', 'now', 'change'))
+    for [metricName, value] in summary.items():
+        baselineValue = baseline['summary'].get(metricName)
+        if baselineValue is None:
+            continue
+        changePrcnt = (value - baselineValue) * 100.0 / baselineValue if baselineValue != 0 else 0.0
+        flag = ''
+        if maxRegressionPrcnt is not None and changePrcnt > maxRegressionPrcnt and metricName in GATED_METRICS:
+            flag = '  << REGRESSION'
+            withinLimits = False
+        print('{:<22} {:>12} {:>12} {:>+8.1f}%{}'.format(metricName, baselineValue, value, changePrcnt, flag))
+    return withinLimits
+
+def main():
+    parser = argparse.ArgumentParser(description='Time full report cycles of ISP-Omega2-mqtt-daemon.py, tick to PUBACK')
+    parser.add_argument('-n', '--cycles', help='cycles to time [Default: 50]', type=int, default=50)
+    parser.add_argument('-w', '--warmup', help='cycles run before timing [Default: 5]', type=int, default=5)
+    parser.add_argument('-p', '--protocol', help='MQTT protocol to use [Default: 3.1.1]', choices=['3.1.1', '5'], default='3.1.1')
+    parser.add_argument('-b', '--baseline', help='baseline file [Default: bench/cycle-baseline.json]', default=default_baseline_filespec)
+    parser.add_argument('--save-baseline', help='write the results as the new baseline', action='store_true')
+    parser.add_argument('--max-regression', help='fail if a metric is this many percent worse than the baseline', type=float, default=None)
+    parser.add_argument('--tls', help='talk TLS to the stand-in broker and check a forced reconnect resumes our session', action='store_true')
+    parser.add_argument('--ubus', help='collect over a stand-in ubusd and check what we decoded (denied: check we fall back)', choices=['ok', 'denied'], default=None)
+    parser.add_argument('--show-daemon-output', help='don\'t silence the daemon\'s own output', action='store_true')
+    benchArgs = parser.parse_args()
+
+    configDir = tempfile.mkdtemp(prefix='omega2-bench-')
+    certFilespec = None
+    brokerTlsContext = None
+    if benchArgs.tls:
+        certFilespec, keyFilespec = makeTlsFiles(configDir)
+        brokerTlsContext = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        brokerTlsContext.load_cert_chain(certFilespec, keyFilespec)
+    broker = FakeBroker(brokerTlsContext)
+    broker.start()
+    _thread.start_new_thread = countingStartNewThread
+    threading.Thread.start = countingThreadStart
+
+    ubusd = None
+    ubusSocketSpec = 'none'
+    if benchArgs.ubus is not None:
+        ubusSocketSpec = os.path.join(configDir, 'ubus.sock')
+        ubusd = FakeUbusd(ubusSocketSpec, deny=benchArgs.ubus == 'denied')
+        ubusd.start()
+    writeConfig(configDir, broker.port, benchArgs.protocol, ubusSocketSpec, certFilespec)
+    realStdout = sys.stdout
+    if not benchArgs.show_daemon_output:
+        sys.stdout = open(os.devnull, 'w')
+    try:
+        daemon = loadDaemon(configDir)
+        watcher = PubackWatcher(daemon)
+        runCycles(daemon, watcher, benchArgs.warmup, False)
+        if benchArgs.tls:
+            forceReconnect(daemon, broker)
+        timedResults = runCycles(daemon, watcher, benchArgs.cycles, False)
+        tracemalloc.start()
+        allocResults = runCycles(daemon, watcher, benchArgs.cycles, True)
+        tracemalloc.stop()
+        stopDaemon(daemon)
+    finally:
+        sys.stdout = realStdout
+        if ubusd is not None:
+            ubusd.stop()
+        for filename in os.listdir(configDir):
+            os.remove(os.path.join(configDir, filename))
+        os.rmdir(configDir)
+
+    withinLimits = True
+    if benchArgs.tls:
+        print('TLS: {} handshakes, {} resumed'.format(daemon['tls_handshake_count'], daemon['tls_resumed_count']))
+        if daemon['tls_resumed_count'] == 0:
+            print('TLS: reconnect did a full handshake, session was not resumed')
+            withinLimits = False
+    if ubusd is not None:
+        ubusProblems = checkUbusValues(daemon, ubusd)
+        for problem in ubusProblems:
+            print('UBUS: {}'.format(problem))
+        if len(ubusProblems) > 0:
+            withinLimits = False
+        else:
+            print('UBUS: {} checked ok'.format('fallback' if ubusd.deny else 'decoded values'))
+
+    summary = summarize(timedResults, allocResults)
+    hostInfo = getHostInfo(benchArgs.protocol, benchArgs.tls, 'ubus' if benchArgs.ubus == 'ok' else 'shell')
+    print('{} cycles (after {} warm-up) on {}, {} publishes ({} bytes) seen by the broker'.format(benchArgs.cycles, benchArgs.warmup, json.dumps(hostInfo), broker.publishCount, broker.publishBytes))
+    if os.path.exists(benchArgs.baseline) and not benchArgs.save_baseline:
+        withinLimits = compareToBaseline(summary, hostInfo, benchArgs.baseline, benchArgs.max_regression) and withinLimits
+    else:
+        for [metricName, value] in summary.items():
+            print('{:<22} {:>12}'.format(metricName, value))
+    if benchArgs.save_baseline:
+        with open(benchArgs.baseline, 'w') as baselineFile:
+            json.dump(OrderedDict([('host', hostInfo), ('cycles', benchArgs.cycles), ('summary', summary)]), baselineFile, indent=2)
+            baselineFile.write('\n')
+        print('Baseline written to {}'.format(benchArgs.baseline))
+    sys.exit(0 if withinLimits else 1)
+
+if __name__ == '__main__':
+    main()